@@ -1,18 +1,45 @@
+"""
+Calls each endpoint of the serving API and writes the responses to `apireturns.txt`, as a smoke test.
+With `--load`, generates load from concurrent clients instead and writes latency histograms and error rates
+per endpoint to `apiload.json`. Both files are written to `output_model_path`.
+"""
+
+import argparse
 import json
+import logging
+import logging.config
+import math
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import requests
+from requests.adapters import HTTPAdapter
+
+import loadtest
+
+# Specify a URL that resolves to your workspace
+URL = "http://127.0.0.1:8000"
 
 
-def run():
-    # Specify a URL that resolves to your workspace
-    URL = "http://127.0.0.1:8000"
+def load_config():
+    with open('config.json', 'r') as f:
+        return json.load(f)
+
 
-    # Call each API endpoint and store the responses
-    response1 = requests.get(f"{URL}/scoring").json()
-    response2 = requests.get(f"{URL}/summarystats").json()
-    response3 = requests.get(f"{URL}/diagnostics").json()
-    response4 = requests.post(url=f"{URL}/prediction?filename=testdata/testdata.csv").json()
+def run(url=URL):
+    # one pooled connection per concurrent call, reused by later calls
+    with requests.Session() as session:
+        session.mount(url, HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
+        # Call each API endpoint concurrently and collect the responses
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            future1 = pool.submit(session.get, f"{url}/scoring")
+            future2 = pool.submit(session.get, f"{url}/summarystats")
+            future3 = pool.submit(session.get, f"{url}/diagnostics")
+            future4 = pool.submit(session.post, f"{url}/prediction?filename=testdata/testdata.csv")
+            response1, response2, response3, response4 = (
+                future.result().json() for future in (future1, future2, future3, future4)
+            )
 
     # combine all API responses
     responses = {
@@ -25,13 +52,95 @@ def run():
     }
 
     # write the responses to your workspace
-    with open('config.json', 'r') as f:
-        config = json.load(f)
+    config = load_config()
     api_returns_path = Path(config['output_model_path']) / Path("apireturns.txt")
 
     with open(api_returns_path, "w") as f:
         f.write(json.dumps(responses))
 
 
+def load(url=URL, clients=8, duration=10.0, mix=None):
+    """Sends requests to the endpoints from `clients` concurrent clients for `duration` seconds and writes
+    latency percentiles and histograms, requests per second and errors per endpoint to `apiload.json`.
+
+    :param mix: dict of endpoint name, as in `loadtest.ENDPOINTS`, to relative share of the requests. Defaults to
+        equal shares.
+    :return: the report written to `apiload.json`
+    """
+    mix = mix or {name: 1.0 for name in loadtest.ENDPOINTS}
+    targets = {}
+    for name in mix:
+        method, path, kwargs = loadtest.ENDPOINTS[name]
+        targets[name] = (method, f"{url}{path}", kwargs)
+
+    logging.info("Sending requests from %i clients for %.0fs", clients, duration)
+    result = loadtest.run_mix(targets, weights=mix, clients=clients, duration=duration)
+
+    endpoints = {}
+    for name, target in result['targets'].items():
+        summary = loadtest.summarize({
+            'latencies': target['latencies'],
+            'errors': sum(target['errors'].values()),
+            'seconds': result['seconds'],
+        })
+        endpoints[name] = {
+            # json has no NaN, which percentiles of an endpoint without successful requests are
+            **{k: None if math.isnan(v) else float(v) for k, v in summary.items()},
+            'errors': dict(target['errors']),
+            'histogram': loadtest.latency_histogram(target['latencies']),
+        }
+        logging.info(
+            "%s: %i requests, %.0f/s, p50 %.2fms, p99 %.2fms, %.2f%% errors",
+            name,
+            summary['requests'],
+            summary['rps'],
+            summary['p50_ms'],
+            summary['p99_ms'],
+            summary['error_rate'] * 100
+        )
+
+    report = {
+        'url': url,
+        'clients': clients,
+        'duration': result['seconds'],
+        'mix': mix,
+        'endpoints': endpoints,
+    }
+    config = load_config()
+    api_load_path = Path(config['output_model_path']) / Path("apiload.json")
+    with open(api_load_path, "w") as f:
+        json.dump(report, f, indent=2)
+    logging.info("Wrote load report to %s", api_load_path)
+    return report
+
+
+def parse_mix(text):
+    """Parses a request mix such as `prediction=4,scoring=1`.
+    """
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in loadtest.ENDPOINTS:
+            raise argparse.ArgumentTypeError(f"unknown endpoint {name}, expected one of {list(loadtest.ENDPOINTS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
 if __name__ == "__main__":
-    run()
+    logging.config.fileConfig('logging.conf')
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", default=URL)
+    parser.add_argument("--load", action="store_true", help="generate load instead of calling each endpoint once")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent clients in load mode")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load")
+    parser.add_argument(
+        "--mix", type=parse_mix, default=None,
+        help="endpoints and their relative share of the load, such as prediction=4,scoring=1. Equal by default."
+    )
+    args = parser.parse_args()
+
+    if args.load:
+        load(args.url, args.clients, args.duration, args.mix)
+    else:
+        run(args.url)
@@ -2,15 +2,25 @@
 Provides a web-based endpoint for serving the model
 """
 
+import hashlib
+import io
 import json
+import logging
 import logging.config
+import os
 import pickle
+import threading
+from datetime import datetime, timezone
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 from flask import Flask, jsonify, request, make_response
 
+import modelartifact
+from compiledmodel import compile_model
 from diagnostics import model_predictions
+from schema import FEATURES
 
 # Set up variables for use in our script
 app = Flask(__name__)
@@ -27,43 +37,246 @@ def read_pandas(filename):
     return df
 
 
-def get_model():
-    model_path = production_path / "trainedmodel.pkl"
-    with open(model_path, 'rb') as file:
-        model = pickle.load(file)
-    return model
+def _as_feature_matrix(array):
+    X = np.asarray(array, dtype=np.float64)
+    if X.ndim != 2 or X.shape[1] != len(FEATURES):
+        raise ValueError(f"expected an (n, {len(FEATURES)}) feature matrix, got shape {X.shape}")
+    if not np.isfinite(X).all():
+        raise ValueError("feature values must be finite numbers")
+    return X
+
+
+def decode_json_payload(payload):
+    """Decodes row records, row arrays or columnar json into a feature matrix ordered as `FEATURES`.
+
+    Accepted shapes:
+     - `[{"lastmonth_activity": 1, ...}, ...]` row records
+     - `[[1, 2, 3], ...]` rows with values in `FEATURES` order
+     - `{"lastmonth_activity": [1, ...], ...}` columns
+    """
+    if isinstance(payload, dict):
+        return _as_feature_matrix(np.column_stack([payload[col] for col in FEATURES]))
+    if isinstance(payload, list):
+        if len(payload) == 0:
+            return np.empty((0, len(FEATURES)))
+        if isinstance(payload[0], dict):
+            return _as_feature_matrix([[row[col] for col in FEATURES] for row in payload])
+        return _as_feature_matrix(payload)
+    raise ValueError("json payload must be a list of rows or an object of columns")
+
+
+def decode_arrow_payload(body):
+    """Decodes an Arrow IPC stream or file into a feature matrix ordered as `FEATURES`.
+    """
+    import pyarrow as pa  # optional dependency, only needed for Arrow clients
+
+    buffer = pa.py_buffer(body)
+    try:
+        table = pa.ipc.open_stream(buffer).read_all()
+    except pa.ArrowInvalid:
+        table = pa.ipc.open_file(buffer).read_all()
+    return _as_feature_matrix(np.column_stack([table.column(col).to_numpy() for col in FEATURES]))
+
+
+def decode_npy_payload(body):
+    """Decodes a serialized NumPy `.npy` array with columns in `FEATURES` order.
+    """
+    return _as_feature_matrix(np.load(io.BytesIO(body), allow_pickle=False))
+
+
+def decode_payload(mimetype, body):
+    """Decodes a request body into a feature matrix based on its content type.
+    """
+    if mimetype == "application/json":
+        return decode_json_payload(json.loads(body))
+    if mimetype in ("application/vnd.apache.arrow.stream", "application/vnd.apache.arrow.file"):
+        return decode_arrow_payload(body)
+    if mimetype in ("application/x-npy", "application/octet-stream"):
+        return decode_npy_payload(body)
+    raise ValueError(f"unsupported content type: {mimetype}")
+
+
+def read_payload():
+    """Decodes the body of the current request into a feature matrix based on its content type.
+    """
+    return decode_payload(request.mimetype, request.get_data())
+
+
+class DeployedFiles:
+    """Keeps an object loaded from deployed files in memory for the lifetime of a worker.
+
+    `deployment.deploy_latest` publishes each deployment by pointing the deployment path symlink at a new version
+    folder, so a single `readlink` per request tells whether the object must be reloaded. Files are then read from
+    the version folder the link pointed at, never from a mix of versions. A plain deployment folder from before
+    versioning is instead identified by the metadata of its files. A freshly loaded object is swapped in as a
+    single reference assignment, so requests already holding the previous object finish with it.
+
+    :param filenames: files the object is loaded from, identifying the version of a plain deployment folder
+    """
+
+    def __init__(self, deployment_path, filenames):
+        self._deployment_path = Path(deployment_path)
+        self._filenames = ["deployedversion.txt"] + list(filenames)
+        self._lock = threading.Lock()
+        self._current = (None, None)  # (version key, object)
+
+    @staticmethod
+    def _stat_key(path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def version(self):
+        """Cheap identifier of the deployment: the symlink target, or file metadata for a plain folder."""
+        try:
+            return os.readlink(self._deployment_path)
+        except OSError:
+            return tuple(self._stat_key(self._deployment_path / Path(name)) for name in self._filenames)
+
+    def _folder(self, key):
+        if isinstance(key, str):
+            return self._deployment_path.parent / Path(key)
+        return self._deployment_path
+
+    def _load(self, folder):
+        """Loads the object from a deployment folder, returning the path it was loaded from and the object."""
+        raise NotImplementedError
 
+    def get(self):
+        """Returns the in-memory object, reloading it first if a new deployment landed."""
+        key = self.version()
+        version, obj = self._current
+        if key == version:
+            return obj
 
-def get_diagnostics_data():
-    diagnostics_path = production_path / Path("latestscore.txt")
-    with open(diagnostics_path) as file:
-        diagnostics_data = json.load(file)
-    return diagnostics_data
+        with self._lock:
+            version, obj = self._current
+            if key == version:
+                return obj
+            try:
+                path, obj = self._load(self._folder(key))
+            except Exception:
+                if version is None:
+                    raise
+                logging.exception("Failed to reload %s, continuing with previous version", type(self).__name__)
+                return obj
+            logging.info("Loaded %s", path)
+            self._current = (key, obj)
+            return obj
 
 
-def get_summary_data():
-    summary_path = production_path / Path("dataset_summary.csv")
-    summary_df = pd.read_csv(summary_path, index_col=0)
-    return summary_df
+class ModelRegistry(DeployedFiles):
+    """Keeps the deployed model in memory.
 
+    The model is loaded from the memory-mapped `trainedmodel.bin` artifact when one is deployed, which needs no
+    sklearn, and otherwise unpickled from `trainedmodel.pkl` and compiled to a `CompiledModel` if supported.
+    """
+
+    def __init__(self, deployment_path, float32=False):
+        super().__init__(deployment_path, ["trainedmodel.bin", "trainedmodel.pkl"])
+        self._float32 = float32
+
+    def _load(self, folder):
+        artifact_path = folder / Path("trainedmodel.bin")
+        model_path = folder / Path("trainedmodel.pkl")
+        if artifact_path.exists():
+            try:
+                return artifact_path, modelartifact.load(artifact_path, float32=self._float32)
+            except modelartifact.ArtifactError:
+                logging.exception("Invalid model artifact, falling back to %s", model_path)
+        with open(model_path, 'rb') as file:
+            return model_path, compile_model(pickle.load(file), float32=self._float32)
+
+
+class ResponseBundle(DeployedFiles):
+    """Keeps the response bodies of the GET endpoints in memory, as written to `responses.json` by
+    `deployment.deploy_latest`. Deployments from before the bundle existed are converted on load.
+    """
+
+    def __init__(self, deployment_path):
+        super().__init__(deployment_path, ["responses.json"])
+
+    def _load(self, folder):
+        bundle_path = folder / Path("responses.json")
+        if bundle_path.exists():
+            with open(bundle_path) as file:
+                bundle = json.load(file)
+            source = bundle_path
+        else:
+            import deployment
+            bundle = {
+                'last_modified': os.stat(folder / Path("latestscore.txt")).st_mtime,
+                'responses': deployment.response_bundle(folder),
+            }
+            source = folder
+
+        last_modified = datetime.fromtimestamp(int(bundle['last_modified']), tz=timezone.utc)
+        responses = {}
+        for name, body in bundle['responses'].items():
+            body = body.encode()
+            responses[name] = (body, hashlib.sha256(body).hexdigest()[:32], last_modified)
+        return source, responses
+
+
+model_registry = ModelRegistry(production_path, float32=config.get('serving_float32', False))
+response_bundle = ResponseBundle(production_path)
+
+
+def get_model():
+    return model_registry.get()
 
-def get_package_data():
-    package_path = production_path / Path("packages.csv")
-    package_df = pd.read_csv(package_path, index_col=0)
-    return package_df
+
+def warm_up():
+    """Loads the deployed model and responses and sends one request to each endpoint through the test client,
+    so the first client request does not pay for loading or first-call initialization.
+    """
+    model_registry.get()
+    response_bundle.get()
+    client = app.test_client()
+    for path in ("/scoring", "/summarystats", "/diagnostics"):
+        client.get(path)
+    client.post("/prediction", json=[[0] * len(FEATURES)])
+
+
+def cached_response(name):
+    """Serves a precomputed response body, answering conditional requests with 304 Not Modified.
+    """
+    body, etag, last_modified = response_bundle.get()[name]
+    response = app.response_class(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    # clients may keep the body but must revalidate it, as it changes with every deployment
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 
 # Prediction Endpoint
 @app.route("/prediction", methods=['POST', 'OPTIONS'])
 def predict():
-    """Takes a filename as input and returns model predictions on that file
+    """Returns model predictions for a `filename` on the server, or for records sent in the request body.
+
+    Body records may be json (rows or columns), an Arrow IPC buffer or a NumPy `.npy` buffer. Predictions for
+    body records are returned as a numeric array.
     """
     filename = request.args.get("filename")
-    df = read_pandas(filename)
+    if filename is not None:
+        df = read_pandas(filename)
+        model = get_model()
+        preds = model_predictions(df, model)
+        preds = [str(i) for i in preds]
+        response = make_response(jsonify({"predictions": preds}))
+        return response
+
+    try:
+        X = read_payload()
+    except (ImportError, KeyError, TypeError, ValueError) as e:
+        return make_response(jsonify({"error": str(e)}), 400)
+
     model = get_model()
-    preds = model_predictions(df, model)
-    preds = [str(i) for i in preds]
-    response = make_response(jsonify({"predictions": preds}))
+    preds = model_predictions(X, model)
+    response = make_response(jsonify({"predictions": preds.tolist()}))
     return response
 
 
@@ -72,9 +285,7 @@ def predict():
 def scoring():
     """Returns production model score on test set that was generated at deployment time
     """
-    score = get_diagnostics_data()['f1_score']
-    response = make_response(jsonify({"score": score}))
-    return response
+    return cached_response('scoring')
 
 
 # Summary Statistics Endpoint
@@ -82,9 +293,7 @@ def scoring():
 def summarystats():
     """Returns summary statistics about the dataset used to train the current model
     """
-    summary = get_summary_data().to_json(index=False, orient='split')
-    response = make_response(jsonify({"summary": summary}))
-    return response
+    return cached_response('summarystats')
 
 
 # Diagnostics Endpoint
@@ -92,22 +301,7 @@ def summarystats():
 def package_versions():
     """Returns diagnostic data generated during training and deployment of the current model.
     """
-    diagnostics = get_diagnostics_data()
-    timing = {k: diagnostics[k] for k in diagnostics if k != "f1_score"}
-
-    summary_df = get_summary_data()
-    missing_data = summary_df.loc["missing"]
-    missing_data = missing_data.to_json(index=False, orient='split')
-
-    packages = get_package_data()
-    packages = packages.to_json(index=False, orient='split')
-
-    response = make_response(jsonify({
-        "timing": timing,
-        "missing_data": missing_data,
-        "packages": packages
-    }))
-    return response
+    return cached_response('diagnostics')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,219 @@
+"""
+Provides an asynchronous variant of the serving API in `app.py`, as a plain ASGI application run by uvicorn:
+`python cli.py serve --asgi`, or `uvicorn asgi:app`.
+
+Prediction requests are queued and coalesced into one vectorized `model_predictions` call per batch. A batch is
+evaluated once it holds `serving_batch_max_rows` rows or `serving_batch_max_wait_ms` milliseconds after its first
+request arrived, whichever comes first, and the predictions are split back into per-request responses. Under many
+small concurrent requests this pays the per-call overhead of the model once per batch instead of once per request.
+The other endpoints serve the same precomputed responses as `app.py`.
+"""
+
+import asyncio
+import json
+import logging
+from email.utils import format_datetime, parsedate_to_datetime
+from urllib.parse import parse_qs
+
+import numpy as np
+
+import app as flask_app
+from diagnostics import model_predictions
+
+BUNDLE_ENDPOINTS = {"/scoring": "scoring", "/summarystats": "summarystats", "/diagnostics": "diagnostics"}
+
+
+class MicroBatcher:
+    """Coalesces concurrent prediction requests into batches evaluated by a single background task.
+    A batch only waits for more requests while other requests are in flight, counted by `inflight`, so a lone
+    request is evaluated immediately.
+
+    :param get_model: callable returning the model to evaluate batches with
+    :param max_rows: rows after which a batch is evaluated without waiting further
+    :param max_wait: seconds a batch waits for more requests after its first one arrived
+    """
+
+    def __init__(self, get_model, max_rows=4096, max_wait=0.002):
+        self.get_model = get_model
+        self.max_rows = max_rows
+        self.max_wait = max_wait
+        self.inflight = 0
+        self.requests = 0
+        self.batches = 0
+        self._queue = None
+        self._task = None
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    async def predict(self, X):
+        """Predictions for the feature matrix `X`, evaluated together with other requests queued meanwhile.
+        """
+        if self._task is None:
+            # servers not sending lifespan events
+            self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((X, future))
+        return await future
+
+    async def _next_batch(self):
+        batch = [await self._queue.get()]
+        rows = len(batch[0][0])
+        deadline = asyncio.get_running_loop().time() + self.max_wait
+        while rows < self.max_rows:
+            if self._queue.empty():
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0 or self.inflight <= len(batch):
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                item = self._queue.get_nowait()
+            batch.append(item)
+            rows += len(item[0])
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            self.requests += len(batch)
+            self.batches += 1
+            try:
+                X = np.concatenate([X for X, _ in batch]) if len(batch) > 1 else batch[0][0]
+                predictions = model_predictions(X, self.get_model())
+                results = np.split(predictions, np.cumsum([len(X) for X, _ in batch[:-1]]))
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                # the client may have disconnected and cancelled its request meanwhile
+                if not future.done():
+                    future.set_result(result)
+
+
+batcher = MicroBatcher(
+    flask_app.get_model,
+    max_rows=flask_app.config.get('serving_batch_max_rows', 4096),
+    max_wait=flask_app.config.get('serving_batch_max_wait_ms', 2.0) / 1000
+)
+
+
+async def read_body(receive):
+    chunks = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        chunks.append(message.get('body', b""))
+        more_body = message.get('more_body', False)
+    return b"".join(chunks)
+
+
+async def send_response(send, status, body, content_type=b"application/json", headers=()):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b"content-type", content_type), (b"content-length", str(len(body)).encode()), *headers],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_json(send, status, payload):
+    await send_response(send, status, json.dumps(payload).encode())
+
+
+async def predict(scope, receive, send):
+    """Returns predictions for a `filename` on the server, or for records sent in the request body, as
+    `app.predict` does.
+    """
+    filename = parse_qs(scope['query_string'].decode()).get('filename')
+    if filename:
+        # reading a csv file blocks, so it runs in a thread rather than on the event loop
+        df = await asyncio.get_running_loop().run_in_executor(None, flask_app.read_pandas, filename[0])
+        preds = model_predictions(df, flask_app.get_model())
+        await send_json(send, 200, {"predictions": [str(i) for i in preds]})
+        return
+
+    headers = dict(scope['headers'])
+    mimetype = headers.get(b"content-type", b"").decode().split(";")[0].strip().lower()
+    batcher.inflight += 1
+    try:
+        try:
+            X = flask_app.decode_payload(mimetype, await read_body(receive))
+        except (ImportError, KeyError, TypeError, ValueError) as e:
+            await send_json(send, 400, {"error": str(e)})
+            return
+        preds = await batcher.predict(X)
+    finally:
+        batcher.inflight -= 1
+    await send_json(send, 200, {"predictions": preds.tolist()})
+
+
+async def bundle_response(scope, send, name):
+    """Serves a precomputed response body, answering conditional requests with 304 Not Modified, as
+    `app.cached_response` does.
+    """
+    body, etag, last_modified = flask_app.response_bundle.get()[name]
+    etag = f'"{etag}"'.encode()
+    headers = [
+        (b"etag", etag),
+        (b"last-modified", format_datetime(last_modified, usegmt=True).encode()),
+        (b"cache-control", b"no-cache"),
+    ]
+    request_headers = dict(scope['headers'])
+    if b"if-none-match" in request_headers:
+        not_modified = etag in [tag.strip() for tag in request_headers[b"if-none-match"].split(b",")]
+    else:
+        try:
+            not_modified = parsedate_to_datetime(request_headers[b"if-modified-since"].decode()) >= last_modified
+        except (KeyError, TypeError, ValueError):
+            not_modified = False
+    if not_modified:
+        await send({'type': 'http.response.start', 'status': 304, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': b""})
+        return
+    await send_response(send, 200, body, headers=headers)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            flask_app.model_registry.get()
+            flask_app.response_bundle.get()
+            batcher.start()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await batcher.stop()
+            logging.info(
+                "Served %i predictions in %i batches", batcher.requests, batcher.batches
+            )
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+
+    path, method = scope['path'], scope['method']
+    if path == "/prediction" and method == "POST":
+        await predict(scope, receive, send)
+    elif path in BUNDLE_ENDPOINTS and method == "GET":
+        await bundle_response(scope, send, BUNDLE_ENDPOINTS[path])
+    elif path == "/prediction" or path in BUNDLE_ENDPOINTS:
+        await send_json(send, 405, {"error": "method not allowed"})
+    else:
+        await send_json(send, 404, {"error": "not found"})
@@ -0,0 +1,387 @@
+"""
+Micro-benchmarks for performance-sensitive parts of the pipeline.
+Run as `python benchmarks.py <benchmark>`, see `python benchmarks.py --help` for the list.
+"""
+
+import argparse
+import json
+import logging
+import logging.config
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import timeit
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from sklearn.linear_model import LogisticRegression
+
+import ingestion
+import loadtest
+import profiling
+import scoring
+import training
+from compiledmodel import compile_model
+from dbsetup import ProjectDB, decode_dataset, encode_dataset
+from schema import FEATURES
+
+
+def synthetic_dataset(n_rows, seed=0):
+    """Random dataset with the same columns and value ranges as the source data.
+    """
+    rng = np.random.default_rng(seed)
+    dataset = pd.DataFrame({
+        "corporation": rng.choice(["abcd", "acme", "bqlx", "lsid", "nciw", "pwls"], size=n_rows),
+        "lastmonth_activity": rng.integers(0, 1500, size=n_rows),
+        "lastyear_activity": rng.integers(0, 15000, size=n_rows),
+        "number_of_employees": rng.integers(1, 1000, size=n_rows),
+    })
+    logit = 0.004 * dataset["lastmonth_activity"] - 0.0002 * dataset["lastyear_activity"] - 1.0
+    dataset["exited"] = (rng.random(n_rows) < 1 / (1 + np.exp(-logit))).astype(int)
+    return dataset
+
+
+def per_call_seconds(func, number):
+    """Best-of-five mean seconds per call of `func`.
+    """
+    return min(timeit.repeat(func, number=number, repeat=5)) / number
+
+
+def bench_scorer(args):
+    """Checks parity of `CompiledModel` with sklearn and compares per-request latency.
+    """
+    dataset = synthetic_dataset(100_000)
+    X = dataset[FEATURES].to_numpy(dtype=np.float64)
+    model = LogisticRegression(solver='liblinear', random_state=0).fit(X, dataset["exited"])
+    compiled = compile_model(model)
+    compiled32 = compile_model(model, float32=True)
+
+    expected = model.predict(X)
+    assert np.array_equal(compiled.predict(X), expected), "float64 compiled model disagrees with sklearn"
+    mismatches = int(np.sum(compiled32.predict(X) != expected))
+    logging.info("Parity with sklearn on %i rows: float64 exact, float32 %i mismatches", len(X), mismatches)
+
+    logging.info("%10s %14s %14s %14s %9s", "batch", "sklearn (us)", "float64 (us)", "float32 (us)", "speedup")
+    for batch_size in args.batch_sizes:
+        batch = X[:batch_size]
+        number = max(10, 20_000 // batch_size)
+        sklearn_time = per_call_seconds(lambda: model.predict(batch), number)
+        compiled_time = per_call_seconds(lambda: compiled.predict(batch), number)
+        compiled32_time = per_call_seconds(lambda: compiled32.predict(batch), number)
+        logging.info(
+            "%10i %14.1f %14.1f %14.1f %8.1fx",
+            batch_size,
+            sklearn_time * 1e6,
+            compiled_time * 1e6,
+            compiled32_time * 1e6,
+            sklearn_time / compiled_time
+        )
+
+
+def bench_storage(args):
+    """Compares dataset load time and database size of csv text against the binary storage formats.
+    """
+    storage_formats = [("csv", False), ("npz", True), ("parquet", False), ("parquet", True)]
+    logging.info("%10s %18s %12s %12s", "rows", "format", "db size (MB)", "load (s)")
+    for n_rows in args.rows:
+        dataset = synthetic_dataset(n_rows)
+        dataset.index = np.arange(n_rows) % 1000  # concatenated source files repeat their index
+        for dataset_format, compress in storage_formats:
+            with tempfile.TemporaryDirectory() as tmp:
+                db_path = Path(tmp) / Path("bench.sqlite")
+                connection = sqlite3.connect(db_path)
+                connection.execute("CREATE TABLE datasets(dataset TEXT, dataset_blob BLOB, dataset_format TEXT);")
+                if dataset_format == "csv":
+                    row = (dataset.to_csv(), None, None)
+                else:
+                    row = (None, *encode_dataset(dataset, compress, dataset_format)[::-1])
+                connection.execute("INSERT INTO datasets VALUES(?, ?, ?);", row)
+                connection.commit()
+
+                def load():
+                    dataset_csv, dataset_blob, stored_format = connection.execute(
+                        "SELECT dataset, dataset_blob, dataset_format FROM datasets;"
+                    ).fetchone()
+                    return decode_dataset(stored_format, dataset_blob, dataset_csv)
+
+                assert load().equals(dataset), f"{dataset_format} does not round-trip"
+                load_time = min(timeit.repeat(load, number=1, repeat=3))
+                connection.close()
+
+                label = dataset_format + (" compressed" if compress else "")
+                size_mb = os.path.getsize(db_path) / 2 ** 20
+                logging.info("%10i %18s %12.2f %12.4f", n_rows, label, size_mb, load_time)
+
+
+def bench_db(args):
+    """Measures ProjectDB insert and latest-version lookup cost as the number of stored versions grows.
+    """
+    dataset = synthetic_dataset(args.dataset_rows)
+    model = LogisticRegression(solver='liblinear', random_state=0).fit(dataset[FEATURES], dataset["exited"])
+
+    working_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            with open('config.json', 'w') as f:
+                json.dump({"db_path": "bench.sqlite"}, f)
+            db = ProjectDB()
+
+            logging.info(
+                "%10s %18s %18s %18s %18s",
+                "versions", "insert data (ms)", "insert model (ms)", "latest data (ms)", "latest model (ms)"
+            )
+            insert_times = []
+            for version in range(1, max(args.checkpoints) + 1):
+                start_time = timeit.default_timer()
+                dataset_id = db.insert_dataset(input_filenames="bench.csv", dataset=dataset)
+                dataset_time = timeit.default_timer() - start_time
+                start_time = timeit.default_timer()
+                db.insert_model(model=model, training_dataset_id=dataset_id)
+                insert_times.append((dataset_time, timeit.default_timer() - start_time))
+
+                if version in args.checkpoints:
+                    latest_dataset_time = per_call_seconds(db.get_latest_dataset, 20)
+                    latest_model_time = per_call_seconds(db.get_latest_model, 20)
+                    recent = np.mean(insert_times[-10:], axis=0)
+                    logging.info(
+                        "%10i %18.2f %18.2f %18.2f %18.2f",
+                        version,
+                        recent[0] * 1e3,
+                        recent[1] * 1e3,
+                        latest_dataset_time * 1e3,
+                        latest_model_time * 1e3
+                    )
+        finally:
+            os.chdir(working_dir)
+
+
+def bench_training(args):
+    """Compares the batch liblinear fit on the loaded dataset with incremental SGD training over stored chunks,
+    by holdout accuracy, wall time and peak memory, including continuing the SGD model on appended rows.
+    """
+    chunk_rows = args.chunk_rows
+    n_chunks = max(1, args.rows // chunk_rows)
+    holdout = synthetic_dataset(100_000, seed=n_chunks + 1)
+    config = {"db_path": "bench.sqlite", "training_epochs": args.epochs}
+
+    def chunks(seeds):
+        for seed in seeds:
+            chunk = synthetic_dataset(chunk_rows, seed=seed)
+            yield chunk, ingestion.row_fingerprints(chunk)
+
+    def report(name, model):
+        timing = profiling.latest_timing(f"benchmark.{name}")
+        accuracy = np.mean(model.predict(holdout[FEATURES]) == holdout["exited"])
+        logging.info(
+            "%14s %10.4f %10.3f %14.2f",
+            name,
+            accuracy,
+            timing['wall_time'],
+            timing['peak_memory_mb']
+        )
+
+    working_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            with open('config.json', 'w') as f:
+                json.dump(config, f)
+            db = ProjectDB()
+            dataset_id = db.insert_dataset_chunks("bench.csv", chunks(range(n_chunks)))
+            appended_id = db.insert_dataset_chunks("bench.csv", chunks([n_chunks]), parent_dataset=dataset_id)
+            logging.info("%i rows in %i chunks, %i appended rows", n_chunks * chunk_rows, n_chunks, chunk_rows)
+            logging.info("%14s %10s %10s %14s", "training", "accuracy", "wall (s)", "peak mem (MB)")
+
+            with profiling.stage("benchmark.liblinear"):
+                dataset = db.load_dataset(dataset_id)
+                model = LogisticRegression(solver='liblinear', random_state=0).fit(
+                    dataset[FEATURES].to_numpy(dtype=np.float64), dataset["exited"]
+                )
+                del dataset
+            report("liblinear", model)
+
+            with profiling.stage("benchmark.sgd"):
+                model = training.fit_incremental(lambda: db.iter_dataset_chunks(dataset_id), config)
+            report("sgd", model)
+
+            with profiling.stage("benchmark.sgd_continue"):
+                model = training.fit_incremental(
+                    lambda: db.iter_dataset_chunks(appended_id, after_dataset=dataset_id), config, model
+                )
+            report("sgd_continue", model)
+        finally:
+            os.chdir(working_dir)
+
+
+def bench_stages(args):
+    """Runs the ingestion, training and scoring stages repeatedly in-process and reports timing percentiles.
+    Uses `config.json` of the working directory, without writing to the database.
+    """
+    stages = {
+        "ingestion": lambda: ingestion.merge_multiple_dataframe(write_db=False),
+        "training": lambda: training.train_model(write_db=False),
+        "scoring": scoring.score_on_test_file,
+    }
+    logging.info(
+        "%10s %10s %10s %10s %10s %10s %10s",
+        "stage", "wall p50", "wall p90", "wall p99", "cpu p50", "cpu p99", "peak MB"
+    )
+    for name, func in stages.items():
+        summary = profiling.benchmark(func, args.repeat, name=f"benchmark.{name}")
+        logging.info(
+            "%10s %10.4f %10.4f %10.4f %10.4f %10.4f %10.2f",
+            name,
+            summary['wall_time_p50'],
+            summary['wall_time_p90'],
+            summary['wall_time_p99'],
+            summary['cpu_time_p50'],
+            summary['cpu_time_p99'],
+            summary['peak_memory_mb_max'] or 0.0
+        )
+
+
+# statements timed by the import benchmark. The eager baseline imports every pipeline module up front, as
+# fullprocess.py did before its stages imported sklearn and matplotlib on first use.
+IMPORT_TARGETS = {
+    "cli": "import cli",
+    "fullprocess": "import fullprocess",
+    "watcher": "import watcher",
+    "app": "import app",
+    "eager": "import ingestion, training, scoring, diagnostics, reporting, deployment",
+}
+
+
+def import_time(statement):
+    """Seconds spent importing modules while running `statement` in a fresh interpreter, from `-X importtime`,
+    and the number of modules imported.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        capture_output=True, text=True, check=True
+    )
+    total_us = 0
+    modules = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        modules += 1
+        # only top-level imports, nested ones are included in their parent's cumulative time
+        if not name[1:].startswith(" "):
+            total_us += int(cumulative_us)
+    return total_us / 1e6, modules
+
+
+def bench_imports(args):
+    """Compares import time of the entry points with importing every pipeline module eagerly.
+    Exits with an error when importing `cli` takes longer than `--max-cli-ms`.
+    """
+    startup_time, startup_modules = min(import_time("pass") for _ in range(args.repeat))
+    logging.info("%12s %12s %10s", "target", "import (ms)", "modules")
+    results = {}
+    for target, statement in IMPORT_TARGETS.items():
+        seconds, modules = min(import_time(statement) for _ in range(args.repeat))
+        results[target] = seconds - startup_time
+        logging.info("%12s %12.1f %10i", target, results[target] * 1e3, modules - startup_modules)
+
+    if args.max_cli_ms is not None and results["cli"] * 1e3 > args.max_cli_ms:
+        logging.error("Importing cli took %.1fms, more than %.1fms", results["cli"] * 1e3, args.max_cli_ms)
+        sys.exit(1)
+
+
+# commands starting a server for the serving benchmark, from the project folder
+SERVERS = {
+    "production": [sys.executable, "cli.py", "serve", "--production"],
+    "asgi": [sys.executable, "cli.py", "serve", "--asgi"],
+    "dev": [sys.executable, "cli.py", "serve"],
+}
+
+
+def bench_serving(args):
+    """Load-tests the serving API and reports requests per second and latency percentiles per endpoint and
+    concurrency, tracing the latency-throughput curve of each endpoint.
+    With `--server`, starts the production (gunicorn), asgi (uvicorn) or development server first and stops it
+    afterwards.
+    """
+    server = None
+    if args.server is not None:
+        server = subprocess.Popen(SERVERS[args.server], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        loadtest.wait_until_up(f"{args.url}/scoring")
+        logging.info(
+            "%14s %11s %10s %10s %10s %10s %10s %10s",
+            "endpoint", "concurrency", "requests/s", "p50 ms", "p90 ms", "p99 ms", "max ms", "errors"
+        )
+        for endpoint in args.endpoints:
+            method, path, kwargs = loadtest.ENDPOINTS[endpoint]
+            for concurrency in args.concurrency:
+                summary = loadtest.summarize(loadtest.run_load(
+                    f"{args.url}{path}", method, n_requests=args.requests, concurrency=concurrency, **kwargs
+                ))
+                logging.info(
+                    "%14s %11i %10.0f %10.2f %10.2f %10.2f %10.2f %9.2f%%",
+                    endpoint,
+                    concurrency,
+                    summary['rps'],
+                    summary['p50_ms'],
+                    summary['p90_ms'],
+                    summary['p99_ms'],
+                    summary['max_ms'],
+                    summary['error_rate'] * 100
+                )
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    logging.config.fileConfig('logging.conf')
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    scorer_parser = subparsers.add_parser("scorer", help=bench_scorer.__doc__)
+    scorer_parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 10, 100, 1000, 100_000])
+    scorer_parser.set_defaults(func=bench_scorer)
+
+    storage_parser = subparsers.add_parser("storage", help=bench_storage.__doc__)
+    storage_parser.add_argument("--rows", type=int, nargs="+", default=[10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7])
+    storage_parser.set_defaults(func=bench_storage)
+
+    db_parser = subparsers.add_parser("db", help=bench_db.__doc__)
+    db_parser.add_argument("--checkpoints", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    db_parser.add_argument("--dataset-rows", type=int, default=1000)
+    db_parser.set_defaults(func=bench_db)
+
+    training_parser = subparsers.add_parser("training", help=bench_training.__doc__)
+    training_parser.add_argument("--rows", type=int, default=1_000_000)
+    training_parser.add_argument("--chunk-rows", type=int, default=100_000)
+    training_parser.add_argument("--epochs", type=int, default=5)
+    training_parser.set_defaults(func=bench_training)
+
+    stages_parser = subparsers.add_parser("stages", help=bench_stages.__doc__)
+    stages_parser.add_argument("--repeat", type=int, default=20)
+    stages_parser.set_defaults(func=bench_stages)
+
+    imports_parser = subparsers.add_parser("imports", help=bench_imports.__doc__)
+    imports_parser.add_argument("--repeat", type=int, default=5)
+    imports_parser.add_argument("--max-cli-ms", type=float, default=None)
+    imports_parser.set_defaults(func=bench_imports)
+
+    serving_parser = subparsers.add_parser("serving", help=bench_serving.__doc__)
+    serving_parser.add_argument("--url", default="http://127.0.0.1:8000")
+    serving_parser.add_argument("--server", choices=sorted(SERVERS), default=None)
+    serving_parser.add_argument("--endpoints", nargs="+", choices=list(loadtest.ENDPOINTS), default=list(loadtest.ENDPOINTS))
+    serving_parser.add_argument("--requests", type=int, default=2000)
+    serving_parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    serving_parser.set_defaults(func=bench_serving)
+
+    args = parser.parse_args()
+    # benchmarks report peak memory, which the pipeline does not trace
+    profiling.track_memory = True
+    args.func(args)
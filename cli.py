@@ -0,0 +1,132 @@
+"""
+Command-line entry point for the pipeline steps, run as `python cli.py <command>`.
+Each command imports only the modules it needs when it runs, so startup and `--help` do not pay for pandas,
+sklearn or matplotlib.
+"""
+
+import argparse
+import json
+import logging
+import logging.config
+import os
+import sys
+
+
+def ingest(args):
+    import ingestion
+    ingestion.merge_multiple_dataframe(
+        write_db=not args.no_db,
+        write_file=args.write_file,
+        streaming=args.streaming,
+        incremental=args.incremental
+    )
+
+
+def train(args):
+    import training
+    training.train_model(write_db=not args.no_db, write_file=args.write_file)
+
+
+def score(args):
+    import scoring
+    if args.write_file:
+        scoring.write_test_score()
+    else:
+        print(scoring.score_on_test_file())
+
+
+def diagnose(args):
+    import diagnostics
+    diagnostics.run()
+
+
+def report(args):
+    import reporting
+    reporting.run()
+
+
+def deploy(args):
+    import deployment
+    deployment.deploy_latest()
+
+
+def run(args):
+    import fullprocess
+    from dbsetup import ProjectDB
+    fullprocess.build_pipeline(load_config(), ProjectDB()).run(force=args.force)
+
+
+def watch(args):
+    import watcher
+    watcher.watch(load_config(), watcher.stop_on_signals())
+
+
+def serve(args):
+    if args.production:
+        # gunicorn preloads the app and forks the workers itself, so it replaces this process
+        command = [sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py"]
+        if args.host is not None or args.port is not None:
+            command += ["--bind", f"{args.host or '0.0.0.0'}:{args.port or 8000}"]
+        os.execv(sys.executable, command + ["wsgi:app"])
+
+    if args.asgi:
+        import uvicorn
+        uvicorn.run("asgi:app", host=args.host or "0.0.0.0", port=args.port or 8000, log_config=None)
+        return
+
+    from app import app
+    app.run(host=args.host or "0.0.0.0", port=args.port or 8000, threaded=True)
+
+
+def load_config():
+    with open('config.json', 'r') as f:
+        return json.load(f)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    ingest_parser = subparsers.add_parser("ingest", help="combine the source files into a new dataset version")
+    ingest_parser.add_argument("--no-db", action="store_true", help="do not write the dataset to the database")
+    ingest_parser.add_argument("--write-file", action="store_true", help="write finaldata.csv and ingestedfiles.txt")
+    ingest_parser.add_argument("--streaming", action="store_true", default=None, help="read the files in chunks")
+    ingest_parser.add_argument("--incremental", action="store_true", default=None, help="only read new files")
+    ingest_parser.set_defaults(func=ingest)
+
+    train_parser = subparsers.add_parser("train", help="train a model on the latest dataset")
+    train_parser.add_argument("--no-db", action="store_true", help="do not write the model to the database")
+    train_parser.add_argument("--write-file", action="store_true", help="write trainedmodel.pkl")
+    train_parser.set_defaults(func=train)
+
+    score_parser = subparsers.add_parser("score", help="score the latest model on the test data")
+    score_parser.add_argument("--write-file", action="store_true", help="write latestscore.txt")
+    score_parser.set_defaults(func=score)
+
+    subparsers.add_parser("diagnose", help="record diagnostics of the latest model").set_defaults(func=diagnose)
+    subparsers.add_parser("report", help="plot the confusion matrix of the latest model").set_defaults(func=report)
+    subparsers.add_parser("deploy", help="deploy the latest model").set_defaults(func=deploy)
+
+    run_parser = subparsers.add_parser("run", help="run the stages of the full process whose inputs changed")
+    run_parser.add_argument("--force", nargs="+", default=(), metavar="STAGE", help="stages to run regardless")
+    run_parser.set_defaults(func=run)
+
+    subparsers.add_parser("watch", help="run the full process whenever source files change").set_defaults(func=watch)
+
+    serve_parser = subparsers.add_parser("serve", help="serve the deployed model")
+    serve_parser.add_argument("--host", default=None, help="defaults to 0.0.0.0, or `serving_bind` in production")
+    serve_parser.add_argument("--port", type=int, default=None, help="defaults to 8000, or `serving_bind` in production")
+    serve_parser.add_argument(
+        "--production", action="store_true", help="serve with gunicorn using gunicorn.conf.py instead of Flask"
+    )
+    serve_parser.add_argument(
+        "--asgi", action="store_true", help="serve asgi.py with uvicorn, batching concurrent predictions"
+    )
+    serve_parser.set_defaults(func=serve)
+    return parser
+
+
+if __name__ == '__main__':
+    logging.config.fileConfig('logging.conf')
+    args = build_parser().parse_args()
+    args.func(args)
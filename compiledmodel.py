@@ -0,0 +1,86 @@
+"""
+Provides a closed-form scoring engine for the binary linear classifiers trained in `training.py`.
+For a fitted `LogisticRegression`, `predict` is a single dot product and threshold, so evaluating
+it directly with NumPy avoids sklearn's per-call input validation. A `StandardScaler` preceding the
+classifier in a `Pipeline` is folded into the coefficients.
+"""
+
+import numpy as np
+
+
+class CompiledModel:
+    """Coefficients extracted from a fitted binary linear classifier, evaluated with plain NumPy.
+
+    :param features: feature names in coefficient order, if known
+    """
+
+    def __init__(self, coef, intercept, classes, dtype=np.float64, features=None):
+        self.dtype = np.dtype(dtype)
+        self.coef = np.ascontiguousarray(coef, dtype=self.dtype).ravel()
+        self.intercept = self.dtype.type(intercept)
+        self.classes = np.asarray(classes)
+        self.features = features
+
+    @classmethod
+    def from_model(cls, model, dtype=np.float64):
+        features = getattr(model, "feature_names_in_", None)
+        scaler, model = split_scaler(model)
+        coef = np.ravel(model.coef_)
+        intercept = model.intercept_[0]
+        if scaler is not None:
+            mean = 0.0 if scaler.mean_ is None else scaler.mean_
+            scale = 1.0 if scaler.scale_ is None else scaler.scale_
+            # w . (x - mean) / scale + b == (w / scale) . x + (b - w . mean / scale)
+            coef, intercept = coef / scale, intercept - np.sum(coef * mean / scale)
+        return cls(
+            coef, intercept, model.classes_, dtype=dtype, features=None if features is None else [str(f) for f in features]
+        )
+
+    def decision_function(self, X):
+        X = np.asarray(X, dtype=self.dtype)
+        # sklearn rejects missing and infinite values rather than predicting from them
+        if not np.isfinite(X).all():
+            raise ValueError("Input X contains NaN or infinity.")
+        return X @ self.coef + self.intercept
+
+    def predict(self, X):
+        return self.classes[(self.decision_function(X) > 0).astype(np.intp)]
+
+
+def split_scaler(model):
+    """Splits a two-step `Pipeline` of a fitted `StandardScaler` and a classifier into its steps.
+
+    :return: tuple of the scaler, or None for other models, and the classifier
+    """
+    steps = getattr(model, "steps", None)
+    # `mean_` and `scale_` identify a fitted StandardScaler without importing sklearn
+    if steps is not None and len(steps) == 2 and hasattr(steps[0][1], "mean_") and hasattr(steps[0][1], "scale_"):
+        return steps[0][1], steps[1][1]
+    return None, model
+
+
+def is_compilable(model):
+    """Checks that a model is a fitted binary linear classifier that `CompiledModel` reproduces exactly,
+    up to rounding of the folded scaler for scaled pipelines.
+    """
+    model = split_scaler(model)[1]
+    coef = getattr(model, "coef_", None)
+    return (
+        coef is not None
+        and np.ndim(coef) == 2
+        and coef.shape[0] == 1
+        and len(getattr(model, "intercept_", ())) == 1
+        and len(getattr(model, "classes_", ())) == 2
+    )
+
+
+def compile_model(model, float32=False):
+    """Returns a `CompiledModel` for supported models, otherwise the model itself.
+
+    :param model: fitted sklearn model, or an already compiled model
+    :param float32: evaluate in single precision, which is faster on large batches but may flip
+        predictions for rows whose decision value is within rounding error of zero
+    """
+    if isinstance(model, CompiledModel) or not is_compilable(model):
+        return model
+    return CompiledModel.from_model(model, dtype=np.float32 if float32 else np.float64)
@@ -0,0 +1,247 @@
+"""
+Provides single-pass summary statistics of the numeric columns of a dataset.
+A profile is updated one chunk at a time, so datasets stored in chunks are summarized without
+loading them whole. Each chunk is converted to one float matrix and all columns are reduced at once.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+# quantiles reported by `DatasetProfile.summary`, by statistic name
+SUMMARY_QUANTILES = {"p25": 0.25, "median": 0.5, "p75": 0.75}
+
+
+class QuantileSketch:
+    """Mergeable summary of a stream of values as at most `max_size` weighted centroids.
+
+    Values are kept exactly until more than `max_size` distinct values have been seen. Beyond that,
+    neighbouring values are merged into centroids of equal weight, which bounds the rank error of
+    quantiles to about `1 / max_size`.
+    """
+
+    def __init__(self, max_size=2048, values=None, weights=None):
+        self.max_size = max_size
+        self.values = np.empty(0) if values is None else np.asarray(values, dtype=np.float64)
+        self.weights = np.empty(0) if weights is None else np.asarray(weights, dtype=np.float64)
+
+    @property
+    def count(self):
+        return float(self.weights.sum())
+
+    def update(self, values, weights=None, is_sorted=False):
+        """Adds values, which must not be NaN.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        weights = np.ones(len(values)) if weights is None else np.asarray(weights, dtype=np.float64)
+        if len(values) == 0:
+            return self
+
+        values = np.concatenate([self.values, values])
+        weights = np.concatenate([self.weights, weights])
+        if not (is_sorted and len(self.values) == 0):
+            order = np.argsort(values, kind='stable')
+            values, weights = values[order], weights[order]
+
+        # combine equal values, so data with few distinct values stays exact
+        starts = np.flatnonzero(np.r_[True, values[1:] != values[:-1]])
+        self.values = values[starts]
+        self.weights = np.add.reduceat(weights, starts)
+
+        if len(self.values) > self.max_size:
+            self._compress()
+        return self
+
+    def _compress(self):
+        cumulative = np.cumsum(self.weights)
+        bins = np.minimum(
+            ((cumulative - self.weights / 2) / cumulative[-1] * self.max_size).astype(np.intp),
+            self.max_size - 1
+        )
+        weights = np.bincount(bins, weights=self.weights)
+        values = np.bincount(bins, weights=self.values * self.weights)
+        nonempty = weights > 0
+        self.values = values[nonempty] / weights[nonempty]
+        self.weights = weights[nonempty]
+
+    def merge(self, other):
+        return self.update(other.values, other.weights)
+
+    def quantile(self, q):
+        """Linearly interpolated quantiles, equal to `pandas.Series.quantile` while values are exact.
+        """
+        if len(self.values) == 0:
+            return np.full(np.shape(q), np.nan)
+        # a centroid spans the ranks of its first and last value, counting ranks from 0
+        end = np.cumsum(self.weights) - 1
+        start = np.minimum(end - self.weights + 1, end)
+        ranks = np.column_stack([start, end]).ravel()
+        return np.interp(np.asarray(q) * (self.count - 1), ranks, np.repeat(self.values, 2))
+
+    def cdf(self, x):
+        """Fraction of values less than or equal to `x`.
+        """
+        if len(self.values) == 0:
+            return np.full(np.shape(x), np.nan)
+        cumulative = np.cumsum(self.weights)
+        index = np.searchsorted(self.values, x, side='right')
+        return np.where(index > 0, cumulative[np.maximum(index - 1, 0)], 0.0) / cumulative[-1]
+
+    def to_dict(self):
+        return {'max_size': self.max_size, 'values': self.values.tolist(), 'weights': self.weights.tolist()}
+
+    @classmethod
+    def from_dict(cls, state):
+        return cls(state['max_size'], state['values'], state['weights'])
+
+
+class DatasetProfile:
+    """Count, missing values, mean, standard deviation, min, max and quantile sketch of numeric columns,
+    accumulated over chunks of a dataset.
+
+    :param columns: columns to profile, defaults to the numeric columns of the first chunk
+    :param sketch_size: maximum number of centroids per column quantile sketch
+    """
+
+    def __init__(self, columns=None, sketch_size=2048):
+        self.columns = None if columns is None else list(columns)
+        self.sketch_size = sketch_size
+        self.rows = 0
+        if self.columns is not None:
+            self._reset_statistics()
+
+    def _reset_statistics(self):
+        n = len(self.columns)
+        self.count = np.zeros(n)
+        self.mean = np.zeros(n)
+        self.m2 = np.zeros(n)
+        self.min = np.full(n, np.inf)
+        self.max = np.full(n, -np.inf)
+        self.sketches = [QuantileSketch(self.sketch_size) for _ in self.columns]
+
+    def _combine(self, rows, count, mean, m2, min_, max_):
+        """Combines moments of further rows with the current ones (Chan et al. parallel variance).
+        """
+        total = self.count + count
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta = mean - self.mean
+            self.mean = np.where(total > 0, self.mean + delta * count / total, 0.0)
+            self.m2 = np.where(total > 0, self.m2 + m2 + delta ** 2 * self.count * count / total, 0.0)
+        self.count = total
+        self.min = np.minimum(self.min, min_)
+        self.max = np.maximum(self.max, max_)
+        self.rows += rows
+
+    def update(self, chunk):
+        """Adds the rows of a dataframe chunk.
+        """
+        if self.columns is None:
+            self.columns = [col for col in chunk.columns if chunk[col].dtype.kind in "biuf"]
+            self._reset_statistics()
+
+        X = chunk[self.columns].to_numpy(dtype=np.float64, na_value=np.nan)
+        present = ~np.isnan(X)
+        count = present.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(present, X, 0.0).sum(axis=0) / count
+            m2 = np.where(present, (X - mean) ** 2, 0.0).sum(axis=0)
+        self._combine(
+            len(chunk),
+            count,
+            np.nan_to_num(mean),
+            m2,
+            np.where(present, X, np.inf).min(axis=0, initial=np.inf),
+            np.where(present, X, -np.inf).max(axis=0, initial=-np.inf)
+        )
+
+        # NaN sorts last, so each sorted column starts with its present values
+        X = np.sort(X, axis=0)
+        for i, sketch in enumerate(self.sketches):
+            sketch.update(X[:count[i], i], is_sorted=True)
+        return self
+
+    @classmethod
+    def from_chunks(cls, chunks, columns=None, sketch_size=2048):
+        """Profile of a dataframe or an iterable of dataframe chunks.
+        """
+        if isinstance(chunks, pd.DataFrame):
+            chunks = [chunks]
+        profile = cls(columns, sketch_size)
+        for chunk in chunks:
+            profile.update(chunk)
+        return profile
+
+    def merge(self, other):
+        """Adds the rows summarized by another profile of the same columns.
+        """
+        if other.columns is None:
+            return self
+        if self.columns is None:
+            self.columns = list(other.columns)
+            self._reset_statistics()
+
+        self._combine(other.rows, other.count, other.mean, other.m2, other.min, other.max)
+        for sketch, other_sketch in zip(self.sketches, other.sketches):
+            sketch.merge(other_sketch)
+        return self
+
+    def sketch(self, column):
+        return self.sketches[self.columns.index(column)]
+
+    def to_dict(self):
+        """Json-serializable state of the profile, restored by `from_dict`.
+        """
+        if self.columns is None:
+            return {'columns': None, 'sketch_size': self.sketch_size}
+        return {
+            'columns': self.columns,
+            'sketch_size': self.sketch_size,
+            'rows': self.rows,
+            'count': self.count.tolist(),
+            'mean': self.mean.tolist(),
+            'm2': self.m2.tolist(),
+            'min': self.min.tolist(),
+            'max': self.max.tolist(),
+            'sketches': [sketch.to_dict() for sketch in self.sketches],
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        profile = cls(state['columns'], state['sketch_size'])
+        if profile.columns is not None:
+            profile.rows = state['rows']
+            for key in ('count', 'mean', 'm2', 'min', 'max'):
+                setattr(profile, key, np.asarray(state[key], dtype=np.float64))
+            profile.sketches = [QuantileSketch.from_dict(sketch) for sketch in state['sketches']]
+        return profile
+
+    def summary(self):
+        """Statistics as a dataframe with one column per profiled column and one row per statistic.
+        `missing` is the fraction of rows missing a value and `stddev` is the sample standard deviation.
+        The first rows are mean, median, stddev and missing, in the order summaries had before quantile sketches,
+        as the API serves them without row labels.
+        """
+        quantiles = {name: np.array([sketch.quantile(q) for sketch in self.sketches])
+                     for name, q in SUMMARY_QUANTILES.items()}
+        with np.errstate(invalid='ignore', divide='ignore'):
+            statistics = {
+                'mean': np.where(self.count > 0, self.mean, np.nan),
+                'median': quantiles.pop('median'),
+                'stddev': np.where(self.count > 1, np.sqrt(self.m2 / (self.count - 1)), np.nan),
+                'missing': (self.rows - self.count) / self.rows if self.rows else np.full(len(self.columns), np.nan),
+                'count': self.count,
+                'min': np.where(self.count > 0, self.min, np.nan),
+                'max': np.where(self.count > 0, self.max, np.nan),
+                **quantiles,
+            }
+        return pd.DataFrame(statistics, index=self.columns).T
+
+    def to_records(self):
+        """Statistics as (column, statistic, value) tuples, for `ProjectDB.insert_dataset_summary`.
+        """
+        summary = self.summary()
+        return [
+            (column, statistic, None if pd.isna(value) else float(value))
+            for column, values in summary.items()
+            for statistic, value in values.items()
+        ]
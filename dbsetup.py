@@ -1,51 +1,351 @@
 import io
 import json
 import logging
+import os
 import pickle
+import re
 import sqlite3
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
+import modelartifact
+import profiling
+
+
+def _encode_npz(dataset, compress):
+    arrays = {
+        "__columns__": np.array([str(col) for col in dataset.columns]),
+        "__index__": dataset.index.to_numpy(),
+    }
+    for i, col in enumerate(dataset.columns):
+        values = dataset[col]
+        if values.dtype.kind not in "biufcmM":
+            # strings are stored as fixed-width unicode so the archive can be loaded without pickle
+            arrays[f"__isna__{i}"] = values.isna().to_numpy()
+            arrays[str(i)] = values.fillna("").to_numpy(dtype=str)
+        else:
+            arrays[str(i)] = values.to_numpy()
+
+    buffer = io.BytesIO()
+    (np.savez_compressed if compress else np.savez)(buffer, **arrays)
+    return buffer.getvalue()
+
+
+def _decode_npz(blob):
+    with np.load(io.BytesIO(blob), allow_pickle=False) as archive:
+        data = {}
+        for i, col in enumerate(archive["__columns__"]):
+            values = archive[str(i)]
+            if values.dtype.kind == "U":
+                values = values.astype(object)
+                values[archive[f"__isna__{i}"]] = np.nan
+            data[col] = values
+        return pd.DataFrame(data, index=archive["__index__"])
+
+
+def encode_dataset(dataset, compress=True, dataset_format=None):
+    """Serializes a dataframe to a typed, columnar binary blob.
+
+    :param dataset: dataframe to serialize, including its index
+    :param compress: compress the blob
+    :param dataset_format: 'parquet' or 'npz'. By default Parquet is used when pyarrow is installed,
+        otherwise a NumPy `.npz` archive with one array per column.
+    :return: tuple of format name and bytes
+    """
+    if dataset_format is None:
+        try:
+            import pyarrow  # noqa: F401
+            dataset_format = "parquet"
+        except ImportError:
+            dataset_format = "npz"
+
+    if dataset_format == "npz":
+        return dataset_format, _encode_npz(dataset, compress)
+
+    buffer = io.BytesIO()
+    dataset.to_parquet(buffer, engine="pyarrow", compression="zstd" if compress else None)
+    return dataset_format, buffer.getvalue()
+
+
+def decode_dataset(dataset_format, blob=None, dataset_csv=None):
+    """Reads a dataset stored by `encode_dataset`, or as CSV text by earlier versions of the database.
+    """
+    if dataset_format == "parquet":
+        return pd.read_parquet(io.BytesIO(blob), engine="pyarrow")
+    if dataset_format == "npz":
+        return _decode_npz(blob)
+    return pd.read_csv(io.StringIO(dataset_csv), index_col=0)
+
+
+class LRUCache:
+    """Thread-safe least-recently-used cache bounded by the total size of its values in bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()  # key -> (value, size)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, load):
+        """Returns the cached value for `key`, calling `load` to create it on a miss.
+        Values larger than the whole cache are returned without being cached.
+
+        :param load: callable returning the value and its size in bytes
+        """
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key][0]
+
+        value, size = load()
+        if size > self.max_bytes:
+            return value
+
+        with self._lock:
+            if key not in self._items:
+                self._items[key] = (value, size)
+                self._total_bytes += size
+                while self._total_bytes > self.max_bytes:
+                    _, (_, evicted_size) = self._items.popitem(last=False)
+                    self._total_bytes -= evicted_size
+        return value
+
+    def put(self, key, value, size):
+        """Caches a value that was just created, such as a dataset or model being written to the database.
+        """
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self._total_bytes -= self._items.pop(key)[1]
+            self._items[key] = (value, size)
+            self._total_bytes += size
+            while self._total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self._total_bytes -= evicted_size
+
+
+class DatasetHandle:
+    """Metadata of a stored dataset version. `data` is loaded from the database on first access.
+
+    Loaded dataframes are shared through the process-wide cache of `ProjectDB`, so treat them as read-only.
+    Supports the dict-style access (`handle['data']`) of earlier versions.
+    """
+
+    def __init__(self, dataset_id=None, file_list=None, creation_date=None):
+        self.id = dataset_id
+        self.file_list = file_list
+        self.creation_date = creation_date
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None and self.id is not None:
+            self._data = ProjectDB.cache().get(('dataset', self.id), self._load)
+        return self._data
+
+    def _load(self):
+        df = ProjectDB.load_dataset(self.id)
+        return df, int(df.memory_usage(deep=True).sum())
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+
+class ModelHandle:
+    """Metadata of a stored model. `model` is unpickled from the database on first access.
+
+    Loaded models are shared through the process-wide cache of `ProjectDB`.
+    Supports the dict-style access (`handle['model']`) of earlier versions.
+    """
+
+    def __init__(self, model_id=None, training_dataset=None, creation_date=None):
+        self.id = model_id
+        self.training_dataset = training_dataset
+        self.creation_date = creation_date
+        self._model = None
+
+    @property
+    def model(self):
+        if self._model is None and self.id is not None:
+            # sized by the stored pickle, as `ProjectDB.insert_model` does, rather than by pickling the model again
+            self._model = ProjectDB.cache().get(('model', self.id), lambda: ProjectDB.load_model_sized(self.id))
+        return self._model
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+
+class ConnectionPool:
+    """Hands out one sqlite connection per thread, so threads never share a connection or cursor.
+
+    Writes go through a read-write connection and reads through a separate read-only connection. With the database
+    in WAL journal mode, readers see the last committed state without blocking, or being blocked by, a writer in
+    another thread or process. Connections are reopened after a fork.
+    """
+
+    def __init__(self, db_path, busy_timeout=30.0):
+        self.db_path = db_path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+
+    def _connect(self, read_only):
+        if read_only:
+            uri = f"{Path(self.db_path).absolute().as_uri()}?mode=ro"
+            connection = sqlite3.connect(uri, uri=True, timeout=self.busy_timeout)
+        else:
+            connection = sqlite3.connect(self.db_path, timeout=self.busy_timeout)
+        connection.execute(f"PRAGMA busy_timeout={int(self.busy_timeout * 1000)};")
+        return connection
+
+    def connection(self, read_only=False):
+        """The calling thread's connection, opened on first use.
+        """
+        if getattr(self._local, "pid", None) != os.getpid():
+            self._local.__dict__.clear()
+            self._local.pid = os.getpid()
+
+        attr = "read_only" if read_only else "read_write"
+        connection = getattr(self._local, attr, None)
+        if connection is None:
+            connection = self._connect(read_only)
+            setattr(self._local, attr, connection)
+        return connection
+
 
 class ProjectDB:
     _instance = None
-    _connection = None
-    _cursor = None
+    _pool = None
+    _cache = None
+    _compress_datasets = True
+    _lock = threading.Lock()
 
     def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super(ProjectDB, cls).__new__(cls)
-            with open('config.json', 'r') as f:
-                config = json.load(f)
-            logging.info("Using database at %s", config['db_path'])
-            cls._connection = sqlite3.connect(config['db_path'])
-            cls._cursor = cls._connection.cursor()
-            cls.setup()
+        with cls._lock:
+            if cls._instance is None:
+                with open('config.json', 'r') as f:
+                    config = json.load(f)
+                logging.info("Using database at %s", config['db_path'])
+                cls._pool = ConnectionPool(config['db_path'], busy_timeout=config.get('db_busy_timeout', 30.0))
+                cls._compress_datasets = config.get('dataset_compression', True)
+                cls._cache = LRUCache(config.get('db_cache_mb', 512) * 2 ** 20)
+                cls.setup()
+                cls._instance = super(ProjectDB, cls).__new__(cls)
         return cls._instance
 
+    @classmethod
+    def cache(cls):
+        """Process-wide cache of loaded datasets and models, keyed by their id.
+        """
+        return cls._cache
+
+    @classmethod
+    def _write_cursor(cls):
+        return cls._pool.connection().cursor()
+
+    @classmethod
+    def _read_cursor(cls):
+        return cls._pool.connection(read_only=True).cursor()
+
+    @classmethod
+    @contextmanager
+    def _write_transaction(cls):
+        """Cursor inside a transaction that holds the database write lock from its first statement,
+        so ids read at the start of the transaction are still free when rows are inserted.
+        Commits on success and rolls back on error.
+        """
+        connection = cls._pool.connection()
+        cursor = connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE;")
+        try:
+            yield cursor
+        except BaseException:
+            connection.rollback()
+            raise
+        connection.commit()
+
     @classmethod
     def setup(cls):
+        cursor = cls._write_cursor()
+
+        # WAL lets readers and a writer use the database concurrently, it is persisted in the database file
+        cursor.execute("PRAGMA journal_mode=WAL;")
 
         # create dataset table
-        cls._cursor.execute("""CREATE TABLE IF NOT EXISTS datasets(
-            id INT PRIMARY KEY,
+        cursor.execute("""CREATE TABLE IF NOT EXISTS datasets(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
             input_filenames TEXT,
             dataset TEXT,
-            creation_time TEXT default CURRENT_TIMESTAMP
+            creation_time TEXT default CURRENT_TIMESTAMP,
+            dataset_blob BLOB,
+            dataset_format TEXT,
+            parent_dataset INT
+        );""")
+
+        # datasets created before binary storage only have the csv `dataset` column
+        cls._migrate_integer_key("datasets")
+        cls._add_missing_columns(
+            "datasets",
+            {"dataset_blob": "BLOB", "dataset_format": "TEXT", "parent_dataset": "INT"}
+        )
+
+        # create dataset_chunks table, holding datasets written incrementally with dataset_format 'chunked'.
+        # A chunked dataset consists of the chunks of its `parent_dataset` followed by its own.
+        cursor.execute("""CREATE TABLE IF NOT EXISTS dataset_chunks(
+            datasetid INT,
+            chunk INT,
+            dataset_blob BLOB,
+            dataset_format TEXT,
+            row_hashes BLOB,
+            PRIMARY KEY(datasetid, chunk),
+            FOREIGN KEY(datasetid) REFERENCES datasets(id)
+        );""")
+        cls._add_missing_columns("dataset_chunks", {"row_hashes": "BLOB"})
+
+        # create dataset_chunks_staging table, holding chunks of a dataset that is still being written
+        cursor.execute("""CREATE TABLE IF NOT EXISTS dataset_chunks_staging(
+            stage TEXT,
+            chunk INT,
+            dataset_blob BLOB,
+            dataset_format TEXT,
+            row_hashes BLOB,
+            PRIMARY KEY(stage, chunk)
+        );""")
+
+        # create dataset_files table, recording the source files of each dataset version
+        cursor.execute("""CREATE TABLE IF NOT EXISTS dataset_files(
+            datasetid INT,
+            filename TEXT,
+            content_hash TEXT,
+            size INT,
+            mtime_ns INT,
+            PRIMARY KEY(datasetid, filename),
+            FOREIGN KEY(datasetid) REFERENCES datasets(id)
         );""")
 
         # create models table
-        cls._cursor.execute("""CREATE TABLE IF NOT EXISTS models(
-            id INT PRIMARY KEY,
+        cursor.execute("""CREATE TABLE IF NOT EXISTS models(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
             model_pkl BLOB,
+            model_artifact BLOB,
             training_dataset INT,
             creation_date TEXT default CURRENT_TIMESTAMP,
             FOREIGN KEY(training_dataset) REFERENCES datasets(datasetid)
         );""")
+        cls._migrate_integer_key("models")
+        cls._add_missing_columns("models", {"model_artifact": "BLOB"})
+        cursor.execute("CREATE INDEX IF NOT EXISTS models_training_dataset ON models(training_dataset);")
 
         # create diagnostics table
-        cls._cursor.execute("""CREATE TABLE IF NOT EXISTS diagnostics(
-            id INT PRIMARY KEY,
+        cursor.execute("""CREATE TABLE IF NOT EXISTS diagnostics(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
             datasetid INT,
             modelid INT,
             ingestion_time FLOAT,
@@ -56,10 +356,48 @@ class ProjectDB:
             FOREIGN KEY(modelid) REFERENCES models(modelid),
             FOREIGN KEY(datasetid) REFERENCES datasets(datasetid)
         );""")
+        cls._migrate_integer_key("diagnostics")
+        cursor.execute("CREATE INDEX IF NOT EXISTS diagnostics_modelid ON diagnostics(modelid, id);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS diagnostics_datasetid ON diagnostics(datasetid);")
+
+        # create stage_timings table, holding the instrumented pipeline stages behind each diagnostics row
+        cursor.execute("""CREATE TABLE IF NOT EXISTS stage_timings(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            diagnosticsid INT,
+            stage TEXT,
+            wall_time FLOAT,
+            cpu_time FLOAT,
+            peak_memory_mb FLOAT,
+            FOREIGN KEY(diagnosticsid) REFERENCES diagnostics(id)
+        );""")
+        cursor.execute("CREATE INDEX IF NOT EXISTS stage_timings_diagnosticsid ON stage_timings(diagnosticsid);")
+
+        # create training_trials table, holding the candidates evaluated by the parameter search of each model
+        cursor.execute("""CREATE TABLE IF NOT EXISTS training_trials(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            modelid INT,
+            params TEXT,
+            mean_score FLOAT,
+            std_score FLOAT,
+            fit_time FLOAT,
+            selected INT,
+            FOREIGN KEY(modelid) REFERENCES models(id)
+        );""")
+        cursor.execute("CREATE INDEX IF NOT EXISTS training_trials_modelid ON training_trials(modelid);")
+
+        # create stage_runs table, holding the input key and outputs of each completed pipeline stage run
+        cursor.execute("""CREATE TABLE IF NOT EXISTS stage_runs(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            stage TEXT,
+            input_key TEXT,
+            outputs TEXT,
+            creation_time TEXT default CURRENT_TIMESTAMP
+        );""")
+        cursor.execute("CREATE INDEX IF NOT EXISTS stage_runs_stage ON stage_runs(stage, id);")
 
         # create dataset_summary table
-        cls._cursor.execute("""CREATE TABLE IF NOT EXISTS dataset_summary(
-            id INT PRIMARY KEY,
+        cursor.execute("""CREATE TABLE IF NOT EXISTS dataset_summary(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
             datasetid INT,
             lastmonth_mean FLOAT,
             lastmonth_median FLOAT,
@@ -72,74 +410,413 @@ class ProjectDB:
             number_of_employees_mean FLOAT,
             number_of_employees_median FLOAT,
             number_of_employees_stddev FLOAT,
-            number_of_employees_missing FLOAT
+            number_of_employees_missing FLOAT,
+            profile TEXT
         );""")
+        # summaries created before `DatasetProfile` states were stored lack the `profile` column
+        cls._migrate_integer_key("dataset_summary")
+        cls._add_missing_columns("dataset_summary", {"profile": "TEXT"})
+        cursor.execute("CREATE INDEX IF NOT EXISTS dataset_summary_datasetid ON dataset_summary(datasetid, id);")
+
+        # create dataset_statistics table, holding one row per column and statistic of a dataset_summary row.
+        # Summaries written by earlier versions have their statistics in the columns of dataset_summary instead.
+        cursor.execute("""CREATE TABLE IF NOT EXISTS dataset_statistics(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            summaryid INT,
+            column_name TEXT,
+            statistic TEXT,
+            value FLOAT,
+            FOREIGN KEY(summaryid) REFERENCES dataset_summary(id)
+        );""")
+        cursor.execute("CREATE INDEX IF NOT EXISTS dataset_statistics_summaryid ON dataset_statistics(summaryid);")
+
+    @classmethod
+    def _migrate_integer_key(cls, table):
+        """Rebuilds a table created with `id INT PRIMARY KEY` by earlier versions, so that `id` becomes an
+        autoincrementing rowid. Existing ids are kept.
+        """
+        cursor = cls._write_cursor()
+        cursor.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?;", (table,))
+        create_sql = cursor.fetchone()[0]
+        if "id INT PRIMARY KEY" not in create_sql:
+            return
+
+        logging.info("Migrating table %s to autoincrement ids", table)
+        create_sql = create_sql.replace("id INT PRIMARY KEY", "id INTEGER PRIMARY KEY AUTOINCREMENT", 1)
+        create_sql = re.sub(rf"^CREATE TABLE \"?{table}\"?", f"CREATE TABLE {table}_migration", create_sql)
+        cursor.execute(f"PRAGMA table_info({table});")
+        columns = ", ".join(row[1] for row in cursor.fetchall())
+        with cls._write_transaction() as cursor:
+            cursor.execute(create_sql)
+            cursor.execute(f"INSERT INTO {table}_migration({columns}) SELECT {columns} FROM {table};")
+            cursor.execute(f"DROP TABLE {table};")
+            cursor.execute(f"ALTER TABLE {table}_migration RENAME TO {table};")
+
+    @classmethod
+    def _add_missing_columns(cls, table, columns):
+        cursor = cls._write_cursor()
+        cursor.execute(f"PRAGMA table_info({table});")
+        existing = {row[1] for row in cursor.fetchall()}
+        for name, column_type in columns.items():
+            if name not in existing:
+                logging.info("Adding column %s to table %s", name, table)
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type};")
+        cursor.connection.commit()
+
+    @classmethod
+    def _insert_dataset_files(cls, cursor, dataset_id, file_records):
+        cursor.executemany(
+            """
+                INSERT INTO dataset_files(datasetid, filename, content_hash, size, mtime_ns)
+                VALUES(?, ?, ?, ?, ?);
+            """,
+            [
+                (dataset_id, filename, record['content_hash'], record['size'], record['mtime_ns'])
+                for filename, record in file_records.items()
+            ]
+        )
+
+    @classmethod
+    def get_dataset_files(cls, dataset_id):
+        """Source files recorded for a dataset version, as a dict of filename to
+        `{'content_hash': ..., 'size': ..., 'mtime_ns': ...}`. Empty for datasets stored without file records.
+        """
+        cursor = cls._read_cursor()
+        cursor.execute(
+            "SELECT filename, content_hash, size, mtime_ns FROM dataset_files WHERE datasetid=?;",
+            (dataset_id,)
+        )
+        return {
+            filename: {'content_hash': content_hash, 'size': size, 'mtime_ns': mtime_ns}
+            for filename, content_hash, size, mtime_ns in cursor.fetchall()
+        }
 
     @classmethod
-    def insert_dataset(cls, input_filenames, dataset):
+    def get_latest_dataset_id(cls):
+        cursor = cls._read_cursor()
+        cursor.execute("SELECT id FROM datasets ORDER BY id DESC LIMIT 1;")
+        latest = cursor.fetchone()
+        return None if latest is None else latest[0]
+
+    @classmethod
+    @profiling.timed("db.insert_dataset")
+    def insert_dataset(cls, input_filenames, dataset, file_records=None):
+        """Stores a dataset version.
+
+        :param input_filenames: comma separated source files of the dataset
+        :param dataset: dataframe, stored in binary columnar form. CSV text is stored as-is.
+        :param file_records: optional dict of source filename to content hash, size and mtime
+        """
         logging.info("Writing dataset to db")
-        cls._cursor.execute("SELECT * FROM datasets")
-        result = cls._cursor.fetchall()
-        next_id = len(result)
+        if isinstance(dataset, str):
+            dataset_csv, dataset_format, dataset_blob = dataset, None, None
+        else:
+            dataset_csv = None
+            dataset_format, dataset_blob = encode_dataset(dataset, compress=cls._compress_datasets)
+
+        with cls._write_transaction() as cursor:
+            cursor.execute(
+                """
+                    INSERT INTO datasets(input_filenames, dataset, dataset_blob, dataset_format)
+                    VALUES(?, ?, ?, ?);
+                """,
+                (input_filenames, dataset_csv, dataset_blob, dataset_format)
+            )
+            dataset_id = cursor.lastrowid
+            if file_records:
+                cls._insert_dataset_files(cursor, dataset_id, file_records)
+
+        # later stages of the same process read the dataset from memory
+        if not isinstance(dataset, str):
+            cls.cache().put(('dataset', dataset_id), dataset, int(dataset.memory_usage(deep=True).sum()))
+        return dataset_id
+
+    @classmethod
+    @profiling.timed("db.insert_dataset_chunks")
+    def insert_dataset_chunks(cls, input_filenames, chunks, file_records=None, parent_dataset=None):
+        """Stores a dataset version one chunk at a time, so the full dataset is never held in memory.
+
+        Each chunk is staged in its own short transaction, so the write lock is not held while `chunks` reads and
+        parses the next one. The version is then published in one final transaction, which moves the staged chunks
+        and only becomes visible to readers once all chunks are written.
+
+        :param input_filenames: comma separated source files of the dataset
+        :param chunks: iterable of (dataframe, uint64 row hashes) pairs with identical columns
+        :param file_records: optional dict of source filename to content hash, size and mtime
+        :param parent_dataset: id of a chunked dataset whose rows precede `chunks`
+        :return: id of the new dataset
+        """
+        logging.info("Writing dataset chunks to db")
+        stage = uuid.uuid4().hex
+        try:
+            for chunk_number, (chunk, row_hashes) in enumerate(chunks):
+                dataset_format, dataset_blob = encode_dataset(chunk, compress=cls._compress_datasets)
+                with cls._write_transaction() as cursor:
+                    cursor.execute(
+                        """
+                            INSERT INTO dataset_chunks_staging(stage, chunk, dataset_blob, dataset_format, row_hashes)
+                            VALUES(?, ?, ?, ?, ?);
+                        """,
+                        (stage, chunk_number, dataset_blob, dataset_format, np.asarray(row_hashes, np.uint64).tobytes())
+                    )
+
+            with cls._write_transaction() as cursor:
+                cursor.execute(
+                    """
+                        INSERT INTO datasets(input_filenames, dataset_format, parent_dataset)
+                        VALUES(?, 'chunked', ?);
+                    """,
+                    (input_filenames, parent_dataset)
+                )
+                dataset_id = cursor.lastrowid
+                cursor.execute(
+                    """
+                        INSERT INTO dataset_chunks(datasetid, chunk, dataset_blob, dataset_format, row_hashes)
+                        SELECT ?, chunk, dataset_blob, dataset_format, row_hashes
+                        FROM dataset_chunks_staging WHERE stage=?;
+                    """,
+                    (dataset_id, stage)
+                )
+                cursor.execute("DELETE FROM dataset_chunks_staging WHERE stage=?;", (stage,))
+                if file_records:
+                    cls._insert_dataset_files(cursor, dataset_id, file_records)
+        except BaseException:
+            with cls._write_transaction() as cursor:
+                cursor.execute("DELETE FROM dataset_chunks_staging WHERE stage=?;", (stage,))
+            raise
+        return dataset_id
+
+    @classmethod
+    def get_dataset_lineage(cls, dataset_id):
+        """Ids of a chunked dataset and its ancestors, oldest first.
+        """
+        cursor = cls._read_cursor()
+        lineage = []
+        while dataset_id is not None:
+            lineage.append(dataset_id)
+            cursor.execute("SELECT parent_dataset FROM datasets WHERE id=?;", (dataset_id,))
+            dataset_id = cursor.fetchone()[0]
+        return lineage[::-1]
+
+    @classmethod
+    def _chunk_numbers(cls, dataset_id):
+        cursor = cls._read_cursor()
+        cursor.execute("SELECT chunk FROM dataset_chunks WHERE datasetid=? ORDER BY chunk;", (dataset_id,))
+        return [row[0] for row in cursor.fetchall()]
 
-        cls._cursor.execute(
-            "INSERT INTO datasets(id, input_filenames, dataset) VALUES(?, ?, ?);",
-            (next_id, input_filenames, dataset)
+    @classmethod
+    def get_row_hashes(cls, dataset_id):
+        """Row hashes stored alongside a chunked dataset and its ancestors, or None for other datasets.
+        """
+        cursor = cls._read_cursor()
+        cursor.execute("SELECT dataset_format FROM datasets WHERE id=?;", (dataset_id,))
+        if cursor.fetchone()[0] != "chunked":
+            return None
+
+        row_hashes = []
+        for lineage_id in cls.get_dataset_lineage(dataset_id):
+            cursor.execute(
+                "SELECT row_hashes FROM dataset_chunks WHERE datasetid=? ORDER BY chunk;",
+                (lineage_id,)
+            )
+            row_hashes.extend(np.frombuffer(row[0], dtype=np.uint64) for row in cursor.fetchall())
+        return np.concatenate(row_hashes) if row_hashes else np.empty(0, dtype=np.uint64)
+
+    @classmethod
+    def iter_dataset_chunks(cls, dataset_id, after_dataset=None):
+        """Yields a stored dataset as dataframes, one per stored chunk.
+        Datasets that were not written in chunks are yielded whole.
+
+        :param after_dataset: id of an ancestor of a chunked dataset, only the rows appended since that version are
+            yielded. Ignored when it is not an ancestor.
+        """
+        cursor = cls._read_cursor()
+        cursor.execute(
+            "SELECT dataset, dataset_blob, dataset_format FROM datasets WHERE id=?;",
+            (dataset_id,)
         )
-        cls._connection.commit()
+        dataset_csv, dataset_blob, dataset_format = cursor.fetchone()
+        if dataset_format != "chunked":
+            yield decode_dataset(dataset_format, dataset_blob, dataset_csv)
+            return
+
+        lineage = cls.get_dataset_lineage(dataset_id)
+        if after_dataset in lineage:
+            lineage = lineage[lineage.index(after_dataset) + 1:]
+        for lineage_id in lineage:
+            for chunk_number in cls._chunk_numbers(lineage_id):
+                # fetch one chunk per query, so callers may use the database between chunks
+                cursor.execute(
+                    "SELECT dataset_blob, dataset_format FROM dataset_chunks WHERE datasetid=? AND chunk=?;",
+                    (lineage_id, chunk_number)
+                )
+                chunk_blob, chunk_format = cursor.fetchone()
+                yield decode_dataset(chunk_format, chunk_blob)
+
+    @classmethod
+    @profiling.timed("db.load_dataset")
+    def load_dataset(cls, dataset_id):
+        """Reads and decodes the data of a stored dataset version.
+        """
+        chunks = list(cls.iter_dataset_chunks(dataset_id))
+        if len(chunks) == 1:
+            return chunks[0]
+        return pd.concat(chunks, axis=0) if chunks else pd.DataFrame()
+
+    @staticmethod
+    def _dataset_from_row(row):
+        if row is None:
+            return DatasetHandle()
+        dataset_id, input_filenames, creation_date = row
+        return DatasetHandle(dataset_id, input_filenames.split(','), creation_date)
 
     @classmethod
     def get_latest_dataset(cls):
-        dset = {'id': None, 'file_list': None, 'data': None, 'creation_date': None}
-        cls._cursor.execute("SELECT * FROM datasets ORDER BY id DESC;")
-        latest_dataset = cls._cursor.fetchone()
-        if latest_dataset is not None:
-            dset['id'] = latest_dataset[0]
-            dset['file_list'] = latest_dataset[1].split(',')
-            dset['data'] = pd.read_csv(io.StringIO(latest_dataset[2]), index_col=0)
-            dset['creation_date'] = latest_dataset[3]
-        return dset
+        """Handle of the latest dataset version, its data is loaded on first access.
+        """
+        cursor = cls._read_cursor()
+        cursor.execute("SELECT id, input_filenames, creation_time FROM datasets ORDER BY id DESC LIMIT 1;")
+        return cls._dataset_from_row(cursor.fetchone())
 
     @classmethod
     def get_dataset(cls, dataset_id):
-        dset = {'id': None, 'file_list': None, 'data': None, 'creation_date': None}
-        cls._cursor.execute(f"SELECT * FROM datasets WHERE id={dataset_id};")
-        latest_dataset = cls._cursor.fetchone()
-        if latest_dataset is not None:
-            dset['id'] = latest_dataset[0]
-            dset['file_list'] = latest_dataset[1].split(',')
-            dset['data'] = pd.read_csv(io.StringIO(latest_dataset[2]), index_col=0)
-            dset['creation_date'] = latest_dataset[3]
-        return dset
+        """Handle of a dataset version, its data is loaded on first access.
+        """
+        cursor = cls._read_cursor()
+        cursor.execute("SELECT id, input_filenames, creation_time FROM datasets WHERE id=?;", (dataset_id,))
+        return cls._dataset_from_row(cursor.fetchone())
 
     @classmethod
+    def migrate_datasets(cls):
+        """Re-encodes datasets stored as CSV text in the binary columnar format.
+        """
+        cursor = cls._read_cursor()
+        cursor.execute("SELECT id FROM datasets WHERE dataset_format IS NULL AND dataset IS NOT NULL;")
+        legacy_ids = [row[0] for row in cursor.fetchall()]
+        logging.info("Migrating %i csv datasets to binary storage", len(legacy_ids))
+        for dataset_id in legacy_ids:
+            cursor.execute("SELECT dataset FROM datasets WHERE id=?;", (dataset_id,))
+            dataset = decode_dataset(None, dataset_csv=cursor.fetchone()[0])
+            dataset_format, dataset_blob = encode_dataset(dataset, compress=cls._compress_datasets)
+            with cls._write_transaction() as write_cursor:
+                write_cursor.execute(
+                    "UPDATE datasets SET dataset=NULL, dataset_blob=?, dataset_format=? WHERE id=?;",
+                    (dataset_blob, dataset_format, dataset_id)
+                )
+
+    @classmethod
+    @profiling.timed("db.insert_model")
     def insert_model(cls, model, training_dataset_id):
+        """Stores a model pickled and, for binary linear classifiers, as a `modelartifact` for serving.
+        """
         logging.info("Writing model to db")
-        cls._cursor.execute("SELECT * FROM models")
-        result = cls._cursor.fetchall()
-        next_id = len(result)
-
         model_txt = pickle.dumps(model)
+        try:
+            artifact = modelartifact.dumps(model)
+        except modelartifact.ArtifactError:
+            logging.info("Model is not a binary linear classifier, storing it as pickle only")
+            artifact = None
 
-        cls._cursor.execute(
-            "INSERT INTO models(id, model_pkl, training_dataset) VALUES(?, ?, ?);",
-            (next_id, model_txt, training_dataset_id)
+        with cls._write_transaction() as cursor:
+            cursor.execute(
+                "INSERT INTO models(model_pkl, model_artifact, training_dataset) VALUES(?, ?, ?);",
+                (model_txt, artifact, training_dataset_id)
+            )
+            model_id = cursor.lastrowid
+
+        cls.cache().put(('model', model_id), model, len(model_txt))
+        return model_id
+
+    @classmethod
+    def load_model(cls, model_id):
+        """Reads and unpickles a stored model.
+        """
+        return cls.load_model_sized(model_id)[0]
+
+    @classmethod
+    @profiling.timed("db.load_model")
+    def load_model_sized(cls, model_id):
+        """Reads and unpickles a stored model.
+
+        :return: tuple of the model and the size of its pickle in bytes
+        """
+        cursor = cls._read_cursor()
+        cursor.execute("SELECT model_pkl FROM models WHERE id=?;", (model_id,))
+        model_pkl = cursor.fetchone()[0]
+        return pickle.loads(model_pkl), len(model_pkl)
+
+    @classmethod
+    def load_model_artifact(cls, model_id):
+        """Reads the `modelartifact` bytes of a stored model, None for models stored as pickle only.
+        """
+        cursor = cls._read_cursor()
+        cursor.execute("SELECT model_artifact FROM models WHERE id=?;", (model_id,))
+        return cursor.fetchone()[0]
+
+    @classmethod
+    def get_model(cls, model_id):
+        """Handle of a stored model, the model itself is unpickled on first access.
+        """
+        cursor = cls._read_cursor()
+        cursor.execute("SELECT id, training_dataset, creation_date FROM models WHERE id=?;", (model_id,))
+        model = cursor.fetchone()
+        if model is None:
+            return ModelHandle()
+        return ModelHandle(*model)
+
+    @classmethod
+    def insert_training_trials(cls, model_id, trials):
+        """Stores the candidates evaluated by the parameter search of a model, as returned by `training.search`.
+        """
+        with cls._write_transaction() as cursor:
+            cursor.executemany(
+                """
+                    INSERT INTO training_trials(modelid, params, mean_score, std_score, fit_time, selected)
+                    VALUES(?, ?, ?, ?, ?, ?);
+                """,
+                [
+                    (
+                        model_id,
+                        json.dumps(t['params']),
+                        t['mean_score'],
+                        t['std_score'],
+                        t['fit_time'],
+                        int(t['selected'])
+                    )
+                    for t in trials
+                ]
+            )
+
+    @classmethod
+    def get_training_trials(cls, model_id):
+        cursor = cls._read_cursor()
+        cursor.execute(
+            """
+                SELECT params, mean_score, std_score, fit_time, selected FROM training_trials
+                WHERE modelid=? ORDER BY id;
+            """,
+            (model_id,)
+        )
+        trials = pd.DataFrame(
+            cursor.fetchall(),
+            columns=['params', 'mean_score', 'std_score', 'fit_time', 'selected']
         )
-        cls._connection.commit()
+        trials['selected'] = trials['selected'].astype(bool)
+        return trials
 
     @classmethod
     def get_latest_model(cls):
-        model = {'id': None, 'model': None, 'training_dataset': None, 'creation_date': None}
-        cls._cursor.execute("SELECT * FROM models ORDER BY id DESC;")
-        latest_dataset = cls._cursor.fetchone()
-        if latest_dataset is not None:
-            model['id'] = latest_dataset[0]
-            model['model'] = pickle.loads(latest_dataset[1])
-            model['training_dataset'] = latest_dataset[2]
-            model['creation_date'] = latest_dataset[3]
-        return model
+        """Handle of the latest model, the model itself is unpickled on first access.
+        """
+        cursor = cls._read_cursor()
+        cursor.execute("SELECT id, training_dataset, creation_date FROM models ORDER BY id DESC LIMIT 1;")
+        latest_model = cursor.fetchone()
+        if latest_model is None:
+            return ModelHandle()
+        return ModelHandle(*latest_model)
 
     @classmethod
+    @profiling.timed("db.insert_diagnostics")
     def insert_diagnostics(
             cls,
             dataset_id,
@@ -150,134 +827,173 @@ class ProjectDB:
             packages_csv
     ):
         logging.info("Writing diagnostics to db")
-        cls._cursor.execute("SELECT * FROM diagnostics ")
-        result = cls._cursor.fetchall()
-        next_id = len(result)
-
-        cls._cursor.execute(
-            """
-                INSERT INTO diagnostics(
-                    id,
-                    datasetid,
-                    modelid,
+        with cls._write_transaction() as cursor:
+            cursor.execute(
+                """
+                    INSERT INTO diagnostics(
+                        datasetid,
+                        modelid,
+                        ingestion_time,
+                        training_time,
+                        f1_score,
+                        packages
+                    )
+                    VALUES(?, ?, ?, ?, ?, ?);
+                """,
+                (
+                    dataset_id,
+                    model_id,
                     ingestion_time,
                     training_time,
                     f1_score,
-                    packages
+                    packages_csv
                 )
-                VALUES(?, ?, ?, ?, ?, ?, ?);
-            """,
-            (
-                next_id,
-                dataset_id,
-                model_id,
-                ingestion_time,
-                training_time,
-                f1_score,
-                packages_csv
             )
-        )
-        cls._connection.commit()
+            return cursor.lastrowid
 
     @classmethod
     def get_diagnostics(cls, model_id):
+        cursor = cls._read_cursor()
         diagnostics = {'ingestion_time': None, 'training_time': None, 'f1_score': None, 'packages': None}
-        cls._cursor.execute(f"SELECT * FROM diagnostics WHERE modelid={model_id} ORDER BY id DESC;")
-        diagnostics_list = cls._cursor.fetchone()
+        cursor.execute(
+            """
+                SELECT ingestion_time, training_time, f1_score, packages
+                FROM diagnostics WHERE modelid=? ORDER BY id DESC LIMIT 1;
+            """,
+            (model_id,)
+        )
+        diagnostics_list = cursor.fetchone()
         if diagnostics_list:
-            diagnostics['ingestion_time'] = diagnostics_list[3]
-            diagnostics['training_time'] = diagnostics_list[4]
-            diagnostics['f1_score'] = diagnostics_list[5]
-            diagnostics['packages'] = diagnostics_list[6]
+            diagnostics['ingestion_time'] = diagnostics_list[0]
+            diagnostics['training_time'] = diagnostics_list[1]
+            diagnostics['f1_score'] = diagnostics_list[2]
+            diagnostics['packages'] = diagnostics_list[3]
         return diagnostics
 
     @classmethod
-    def insert_dataset_summary(
-            cls,
-            dataset_id,
-            lastmonth_activity_mean,
-            lastmonth_activity_median,
-            lastmonth_activity_stddev,
-            lastmonth_activity_missing,
-            lastyear_activity_mean,
-            lastyear_activity_median,
-            lastyear_activity_stddev,
-            lastyear_activity_missing,
-            number_of_employees_mean,
-            number_of_employees_median,
-            number_of_employees_stddev,
-            number_of_employees_missing,
-    ):
+    def insert_stage_timings(cls, diagnostics_id, timings):
+        """Stores stage records, as produced by `profiling.get_timings`, for a diagnostics row.
+        """
+        with cls._write_transaction() as cursor:
+            cursor.executemany(
+                """
+                    INSERT INTO stage_timings(diagnosticsid, stage, wall_time, cpu_time, peak_memory_mb)
+                    VALUES(?, ?, ?, ?, ?);
+                """,
+                [
+                    (diagnostics_id, t['stage'], t['wall_time'], t['cpu_time'], t['peak_memory_mb'])
+                    for t in timings
+                ]
+            )
+
+    @classmethod
+    def get_stage_timings(cls, diagnostics_id):
+        cursor = cls._read_cursor()
+        cursor.execute(
+            "SELECT stage, wall_time, cpu_time, peak_memory_mb FROM stage_timings WHERE diagnosticsid=? ORDER BY id;",
+            (diagnostics_id,)
+        )
+        return pd.DataFrame(cursor.fetchall(), columns=['stage', 'wall_time', 'cpu_time', 'peak_memory_mb'])
+
+    @classmethod
+    def insert_stage_run(cls, stage, input_key, outputs):
+        """Records a completed run of a pipeline stage.
+
+        :param outputs: json-serializable outputs of the run
+        """
+        with cls._write_transaction() as cursor:
+            cursor.execute(
+                "INSERT INTO stage_runs(stage, input_key, outputs) VALUES(?, ?, ?);",
+                (stage, input_key, json.dumps(outputs))
+            )
+            return cursor.lastrowid
+
+    @classmethod
+    def get_latest_stage_run(cls, stage):
+        """Input key and outputs of the latest run of a pipeline stage, or None if it never ran.
+        """
+        cursor = cls._read_cursor()
+        cursor.execute(
+            "SELECT input_key, outputs FROM stage_runs WHERE stage=? ORDER BY id DESC LIMIT 1;",
+            (stage,)
+        )
+        row = cursor.fetchone()
+        return None if row is None else (row[0], json.loads(row[1]))
+
+    @classmethod
+    @profiling.timed("db.insert_dataset_summary")
+    def insert_dataset_summary(cls, dataset_id, statistics, profile=None):
+        """Stores summary statistics of a dataset.
+
+        :param statistics: (column, statistic, value) tuples, as produced by `DatasetProfile.to_records`
+        :param profile: optional profile state, as produced by `DatasetProfile.to_dict`
+        """
         logging.info("Writing dataset summary to db")
-        cls._cursor.execute("SELECT * FROM dataset_summary")
-        result = cls._cursor.fetchall()
-        next_id = len(result)
-        cls._cursor.execute(
-            """
-                INSERT INTO dataset_summary(
-                    id,
-                    datasetid,
-                    lastmonth_mean,
-                    lastmonth_median,
-                    lastmonth_stddev,
-                    lastmonth_missing,
-                    lastyear_mean,
-                    lastyear_median,
-                    lastyear_stddev,
-                    lastyear_missing,
-                    number_of_employees_mean,
-                    number_of_employees_median,
-                    number_of_employees_stddev,
-                    number_of_employees_missing
-                )
-                VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-            (
-                next_id,
-                dataset_id,
-                lastmonth_activity_mean,
-                lastmonth_activity_median,
-                lastmonth_activity_stddev,
-                lastmonth_activity_missing,
-                lastyear_activity_mean,
-                lastyear_activity_median,
-                lastyear_activity_stddev,
-                lastyear_activity_missing,
-                number_of_employees_mean,
-                number_of_employees_median,
-                number_of_employees_stddev,
-                number_of_employees_missing,
+        with cls._write_transaction() as cursor:
+            cursor.execute(
+                "INSERT INTO dataset_summary(datasetid, profile) VALUES(?, ?);",
+                (dataset_id, None if profile is None else json.dumps(profile))
+            )
+            summary_id = cursor.lastrowid
+            cursor.executemany(
+                "INSERT INTO dataset_statistics(summaryid, column_name, statistic, value) VALUES(?, ?, ?, ?);",
+                [(summary_id, column, statistic, value) for column, statistic, value in statistics]
             )
+            return summary_id
+
+    @classmethod
+    def get_dataset_profile(cls, dataset_id):
+        """Latest stored profile state of a dataset, or None if no summary of it stored one.
+        """
+        cursor = cls._read_cursor()
+        cursor.execute(
+            "SELECT profile FROM dataset_summary WHERE datasetid=? AND profile IS NOT NULL ORDER BY id DESC LIMIT 1;",
+            (dataset_id,)
         )
-        cls._connection.commit()
+        row = cursor.fetchone()
+        return None if row is None else json.loads(row[0])
+
+    # statistics columns of dataset_summary rows written by earlier versions
+    LEGACY_SUMMARY_COLUMNS = {
+        'lastmonth_activity': 'lastmonth',
+        'lastyear_activity': 'lastyear',
+        'number_of_employees': 'number_of_employees',
+    }
 
     @classmethod
     def get_summary(cls, dataset_id):
-        cls._cursor.execute(f"SELECT * FROM dataset_summary WHERE datasetid={dataset_id} ORDER BY id DESC;")
-        summary_list = cls._cursor.fetchone()
+        """Latest summary statistics of a dataset, with one column per dataset column and one row per statistic.
+        """
+        cursor = cls._read_cursor()
+        cursor.execute("SELECT * FROM dataset_summary WHERE datasetid=? ORDER BY id DESC LIMIT 1;", (dataset_id,))
+        row = cursor.fetchone()
+        legacy = dict(zip([d[0] for d in cursor.description], row))
+
+        cursor.execute(
+            "SELECT column_name, statistic, value FROM dataset_statistics WHERE summaryid=? ORDER BY id;",
+            (legacy['id'],)
+        )
+        statistics = cursor.fetchall()
+        if statistics:
+            summary = pd.DataFrame(statistics, columns=['column', 'statistic', 'value'])
+            summary = summary.pivot(index='statistic', columns='column', values='value')
+            # keep the order the statistics were written in
+            summary = summary.reindex(
+                index=list(dict.fromkeys(s for _, s, _ in statistics)),
+                columns=list(dict.fromkeys(c for c, _, _ in statistics))
+            )
+            summary.index.name = None
+            summary.columns.name = None
+            return summary
+
         summary = {
-            'lastmonth_activity': {
-                'mean': summary_list[2],
-                'median': summary_list[3],
-                'stddev': summary_list[4],
-                'missing': summary_list[5]
-            },
-            'lastyear_activity': {
-                'mean': summary_list[6],
-                'median': summary_list[7],
-                'stddev': summary_list[8],
-                'missing': summary_list[9]
-            },
-            'number_of_employees': {
-                'mean': summary_list[10],
-                'median': summary_list[11],
-                'stddev': summary_list[12],
-                'missing': summary_list[13]
-            }
+            column: {statistic: legacy[f"{prefix}_{statistic}"] for statistic in ('mean', 'median', 'stddev', 'missing')}
+            for column, prefix in cls.LEGACY_SUMMARY_COLUMNS.items()
         }
-        summary = pd.DataFrame(summary)
-        return summary
+        return pd.DataFrame(summary)
 
 
 if __name__ == "__main__":
     logging.getLogger().setLevel(logging.INFO)
     db = ProjectDB()
+    db.migrate_datasets()
@@ -5,29 +5,121 @@ Provides functionality for 'deploying' an ML model.
 import json
 import logging
 import logging.config
+import os
 import pickle
+import shutil
+import time
 from pathlib import Path
 
+import pandas as pd
+
+import modelartifact
 from dbsetup import ProjectDB
 
 
-def deploy_latest():
-    """Writes latest model and associated reporting objects to a deployment folder
+def publish(version_folder, deployment_path):
+    """Points the `deployment_path` symlink at a version folder. The new link is created next to the old one and
+    renamed over it, so readers resolve either the previous or the new version, never a mix.
+    """
+    deployment_path = Path(deployment_path)
+    if deployment_path.is_dir() and not deployment_path.is_symlink():
+        # deployments from before versioning wrote their files into the deployment path itself
+        legacy_folder = version_folder.parent / Path("0-legacy")
+        logging.info("Moving unversioned deployment %s to %s", deployment_path, legacy_folder)
+        os.rename(deployment_path, legacy_folder)
+
+    tmp_link = deployment_path.with_name(f".{deployment_path.name}.tmp")
+    if tmp_link.is_symlink():
+        tmp_link.unlink()
+    os.symlink(os.path.relpath(version_folder, deployment_path.parent), tmp_link)
+    os.replace(tmp_link, deployment_path)
+
+
+def current_version(deployment_path):
+    """Version folder the deployment path points at, None if nothing was published.
+    """
+    deployment_path = Path(deployment_path)
+    if not deployment_path.is_symlink():
+        return None
+    return (deployment_path.parent / os.readlink(deployment_path)).resolve()
+
+
+def prune_versions(versions_folder, keep, deployment_path):
+    """Removes all but the `keep` newest version folders, never the published one.
+    """
+    current = current_version(deployment_path)
+    versions = sorted(
+        path for path in Path(versions_folder).iterdir() if path.is_dir() and not path.name.startswith(".")
+    )
+    for path in versions[:max(len(versions) - keep, 0)]:
+        if path.resolve() != current:
+            logging.info("Removing deployment version %s", path)
+            shutil.rmtree(path)
+
+
+def response_bundle(deployment_folder):
+    """Serialized bodies of the app's GET endpoints, built from the files of a deployment, so the app serves
+    them without reading or converting files per request.
+
+    :return: dict of endpoint name to json body
+    """
+    deployment_folder = Path(deployment_folder)
+    with open(deployment_folder / Path("latestscore.txt")) as file:
+        diagnostics = json.load(file)
+    summary_df = pd.read_csv(deployment_folder / Path("dataset_summary.csv"), index_col=0)
+    packages_df = pd.read_csv(deployment_folder / Path("packages.csv"), index_col=0)
+
+    return {
+        'scoring': json.dumps({"score": diagnostics['f1_score']}),
+        'summarystats': json.dumps({"summary": summary_df.to_json(index=False, orient='split')}),
+        'diagnostics': json.dumps({
+            "timing": {k: diagnostics[k] for k in diagnostics if k != "f1_score"},
+            "missing_data": summary_df.loc["missing"].to_json(index=False, orient='split'),
+            "packages": packages_df.to_json(index=False, orient='split'),
+        }),
+    }
+
+
+def deploy_latest(model_obj=None):
+    """Writes latest model and associated reporting objects to a new version folder in `deployment_versions_path`
+    and publishes it by pointing the `prod_deployment_path` symlink at it.
+
+    :param model_obj: handle of the model to deploy, defaults to the latest model
+    :return: id of the deployed model
     """
     with open('config.json', 'r') as f:
         config = json.load(f)
 
-    deployment_folder = Path(config["prod_deployment_path"])
-
-    logging.info("Logging production artifacts to %s", deployment_folder)
+    deployment_path = Path(config["prod_deployment_path"])
+    versions_folder = Path(config.get("deployment_versions_path", f"{deployment_path}_versions"))
 
     db = ProjectDB()
 
-    model_obj = db.get_latest_model()
+    if model_obj is None:
+        model_obj = db.get_latest_model()
     dataset_obj = db.get_dataset(model_obj['training_dataset'])
     diagnostics = db.get_diagnostics(model_obj['id'])
     summary = db.get_summary(dataset_obj['id'])
 
+    # files are written to a hidden folder that is renamed once complete, so a version is never seen partially
+    version_name = f"{time.time_ns()}-model{model_obj['id']}"
+    deployment_folder = versions_folder / Path(f".{version_name}.tmp")
+    deployment_folder.mkdir(parents=True)
+    logging.info("Logging production artifacts to %s", versions_folder / Path(version_name))
+
+    # the app serves the compact artifact when there is one and falls back to the pickle otherwise
+    artifact_output_name = deployment_folder / Path("trainedmodel.bin")
+    artifact = db.load_model_artifact(model_obj['id'])
+    if artifact is None:
+        try:
+            # models stored before artifacts were introduced
+            artifact = modelartifact.dumps(model_obj['model'])
+        except modelartifact.ArtifactError:
+            pass
+    if artifact is not None:
+        with open(artifact_output_name, 'wb') as file:
+            file.write(artifact)
+
     model_output_name = deployment_folder / Path("trainedmodel.pkl")
     with open(model_output_name, 'wb') as file:
         pickle.dump(model_obj['model'], file)
@@ -46,8 +138,28 @@ def deploy_latest():
 
     dataset_summary_name = deployment_folder / Path("dataset_summary.csv")
     summary.to_csv(dataset_summary_name)
-    
+
+    bundle_name = deployment_folder / Path("responses.json")
+    bundle = {
+        'model_id': model_obj['id'],
+        'last_modified': time.time(),
+        'responses': response_bundle(deployment_folder),
+    }
+    with open(bundle_name, 'w') as file:
+        json.dump(bundle, file)
+
+    deployed_version_name = deployment_folder / Path("deployedversion.txt")
+    with open(deployed_version_name, 'w') as file:
+        file.write(str(model_obj['id']))
+
+    version_folder = versions_folder / Path(version_name)
+    os.rename(deployment_folder, version_folder)
+    publish(version_folder, deployment_path)
+    logging.info("Published %s as %s", version_folder, deployment_path)
+
+    prune_versions(versions_folder, config.get('deployment_keep_versions', 5), deployment_path)
     logging.info("Deployment completed")
+    return model_obj['id']
 
 
 if __name__ == "__main__":
@@ -2,27 +2,37 @@
 Includes all 'diagnostics' functionality required by project specifications.
 """
 
+import json
 import logging
 import logging.config
-import os
-import subprocess
-import timeit
-
+import re
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from importlib import metadata
+from pathlib import Path
+
+import numpy as np
 import pandas as pd
 
+import profiling
+from datasetprofile import DatasetProfile
 from dbsetup import ProjectDB
+from schema import FEATURES
 from scoring import score_model
 
 
 def model_predictions(dataset, model):
     """Gets model predictions on a dataset.
     NOTE: it really shouldn't be here, but the rubric requires it to be here.
+
+    :param dataset: dataframe containing the feature columns, or an (n, 3) array already in `FEATURES` order
     """
-    X = dataset[[
-        "lastmonth_activity",
-        "lastyear_activity",
-        "number_of_employees",
-    ]]
+    if isinstance(dataset, np.ndarray):
+        X = dataset
+    else:
+        X = dataset[FEATURES]
 
     y_pred = model.predict(X)
 
@@ -30,96 +40,164 @@ def model_predictions(dataset, model):
 
 
 def dataframe_summary(dataset):
-    """Column-wise summary statistics
+    """Column-wise summary statistics of the feature columns
+
+    :param dataset: dataframe, or iterable of dataframe chunks
     """
     logging.info("Calculating summary statistics")
-    numerical_cols = [
-        "lastmonth_activity",
-        "lastyear_activity",
-        "number_of_employees",
-    ]
-
-    summary = {key: [] for key in numerical_cols}
-    for col in numerical_cols:
-        summary[col].append(dataset[col].mean())
-        summary[col].append(dataset[col].median())
-        summary[col].append(dataset[col].std())
-
-    summary = pd.DataFrame(summary, index=['mean', 'median', 'stddev'])
-    return summary
+    return DatasetProfile.from_chunks(dataset, columns=FEATURES).summary()
 
 
 def check_missing_data(dataset):
     """Column-wise percent of values missing
-    """
-    numerical_cols = [
-        "lastmonth_activity",
-        "lastyear_activity",
-        "number_of_employees",
-    ]
 
-    pct_na = {}
-    for col in numerical_cols:
-        pct_na[col] = dataset[col].isna().sum() / len(dataset)
-    return pct_na
+    :param dataset: dataframe, or iterable of dataframe chunks
+    """
+    return dataframe_summary(dataset).loc['missing'].to_dict()
 
 
 def execution_time():
-    """Times data ingestion and model training processes
+    """Times data ingestion and model training processes.
+    Uses the timings recorded when they ran earlier in this process, otherwise runs them in-process
+    without writing to the database.
     """
-    logging.info("Timing data ingestion.")
-    start_time = timeit.default_timer()
-    os.system("python ingestion.py")
-    ingestion_timing = timeit.default_timer() - start_time
+    ingestion_timing = profiling.latest_timing("ingestion")
+    if ingestion_timing is None:
+        logging.info("Timing data ingestion.")
+        import ingestion
+        ingestion.merge_multiple_dataframe(write_db=False)
+        ingestion_timing = profiling.latest_timing("ingestion")
 
-    logging.info("Timing model training.")
-    start_time = timeit.default_timer()
-    os.system("python training.py")
-    training_timing = timeit.default_timer() - start_time
+    training_timing = profiling.latest_timing("training")
+    if training_timing is None:
+        logging.info("Timing model training.")
+        import training  # imports sklearn, only needed when training did not run in this process
+        training.train_model(write_db=False)
+        training_timing = profiling.latest_timing("training")
 
-    return ingestion_timing, training_timing
+    return ingestion_timing['wall_time'], training_timing['wall_time']
 
 
-def outdated_packages_list():
-    """Creates a dataframe with all pip packages installed, including current and latest-available versions
+# packages left out by `pip freeze`
+PIP_FREEZE_EXCLUDED = {"pip", "setuptools", "wheel", "distribute"}
+
+
+def normalize_package_name(name):
+    """Canonical form of a package name used by package indexes (PEP 503).
     """
-    logging.info("Checking packages with pip.")
-    current = subprocess.run(['pip', 'freeze'], check=True, stdout=subprocess.PIPE, text=True).stdout
-    df = pd.DataFrame(columns=["Package", "Installed", "Latest"])
-    for c in current.splitlines():
-        package = c.split('==')[0]
-        installed = c.split('==')[1]
+    return re.sub(r"[-_.]+", "-", name).lower()
 
-        pip_result = str(subprocess.run(['pip', 'install', f"{package}==nothing"], capture_output=True, text=True))
-        versions_start = pip_result.find("(from versions: ") + 16  # +16 to exclude the "(from versions: " text
-        versions_end = pip_result.find(')')
-        versions = pip_result[versions_start:versions_end]
-        versions = versions.replace(',', '').split(' ')
-        latest_version = versions[-1].strip()
 
-        df.loc[len(df)] = (package, installed, latest_version)
+def installed_packages():
+    """Installed distributions as a dict of name to version, read from package metadata without running pip.
+    """
+    packages = {}
+    for dist in metadata.distributions():
+        name = dist.metadata['Name']
+        if name and normalize_package_name(name) not in PIP_FREEZE_EXCLUDED:
+            packages[name] = dist.version
+    return dict(sorted(packages.items(), key=lambda item: item[0].lower()))
 
-    return df
 
+def fetch_latest_version(index_url, package, timeout=10):
+    """Latest version of a package from an index implementing the PyPI JSON API, or None if unavailable.
+    """
+    url = f"{index_url.rstrip('/')}/{normalize_package_name(package)}/json"
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            return json.load(response)['info']['version']
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning("Could not look up %s: %s", package, e)
+        return None
+
+
+def index_reachable(index_url, timeout=5):
+    """Whether the package index answers at all, so an offline machine waits for one timeout instead of one per
+    package. Any HTTP response, including an error status, counts as reachable.
+    """
+    try:
+        with urllib.request.urlopen(index_url, timeout=timeout):
+            return True
+    except urllib.error.HTTPError:
+        return True
+    except (OSError, ValueError) as e:
+        logging.warning("Package index %s is unreachable: %s", index_url, e)
+        return False
+
+
+def latest_package_versions(packages, config):
+    """Latest available version of each package, keyed by normalized name.
+
+    Versions come from the json cache at `package_cache_path` while it is younger than `package_cache_ttl` seconds,
+    or indefinitely if its `created` time is null, as for a snapshot copied in for machines without access to an
+    index. Other packages are looked up concurrently in `package_index_url`, if one is configured and reachable, and
+    the cache is updated. Expired cache entries are used for packages that could not be looked up.
+    """
+    cache_path = config.get('package_cache_path')
+    ttl = config.get('package_cache_ttl', 86400)
+    index_url = config.get('package_index_url')
+    timeout = config.get('package_lookup_timeout', 5)
+
+    cache = {'created': time.time(), 'latest': {}}
+    if cache_path and Path(cache_path).exists():
+        with open(cache_path) as f:
+            cache = json.load(f)
+    created = cache.get('created', 0)
+    expired = created is not None and time.time() - created >= ttl
+    latest = {} if expired else dict(cache['latest'])
+
+    missing = [package for package in packages if normalize_package_name(package) not in latest]
+    fetched = {}
+    if missing and index_url and index_reachable(index_url, timeout):
+        logging.info("Looking up %i packages in %s", len(missing), index_url)
+        with ThreadPoolExecutor(max_workers=config.get('package_lookup_workers', 16)) as pool:
+            versions = pool.map(lambda package: fetch_latest_version(index_url, package, timeout), missing)
+        fetched = {normalize_package_name(p): v for p, v in zip(missing, versions) if v is not None}
+
+    if fetched and cache_path:
+        # an expired cache only counts as renewed once every package was looked up again
+        renewed = expired and len(fetched) == len(missing)
+        with open(cache_path, 'w') as f:
+            json.dump({
+                'created': time.time() if renewed else created,
+                'latest': {**cache['latest'], **fetched}
+            }, f)
+
+    failed = {normalize_package_name(package) for package in missing} - set(fetched)
+    stale = {name: version for name, version in cache['latest'].items() if name in failed}
+    if stale:
+        logging.info("Using expired cached versions of %i packages", len(stale))
+    return {**latest, **stale, **fetched}
 
-def run():
-    """Calculates all required reporting data and saves to database
+
+def outdated_packages_list():
+    """Creates a dataframe with all pip packages installed, including current and latest-available versions.
+    The latest version is empty for packages that could not be looked up.
     """
-    db = ProjectDB()
+    with open('config.json', 'r') as f:
+        config = json.load(f)
 
-    dataset_obj = db.get_latest_dataset()
-    dataset = dataset_obj['data']
+    logging.info("Checking installed packages.")
+    packages = installed_packages()
+    latest = latest_package_versions(packages, config)
 
-    model_obj = db.get_latest_model()
-    model = model_obj['model']
+    rows = [
+        (package, installed, latest.get(normalize_package_name(package), ""))
+        for package, installed in packages.items()
+    ]
+    return pd.DataFrame(rows, columns=["Package", "Installed", "Latest"])
 
-    score = score_model(dataset, model)
-    summary = dataframe_summary(dataset)
-    pct_missing = check_missing_data(dataset)
+
+def record_diagnostics(dataset_obj, model_obj, score, profile, packages_df):
+    """Saves diagnostics of a model, the stage timings of this process and the summary statistics of a dataset
+    to the database.
+
+    :return: id of the diagnostics row
+    """
+    db = ProjectDB()
     ingestion_timing, training_timing = execution_time()
-    packages_df = outdated_packages_list()
 
-    db.insert_diagnostics(
+    diagnostics_id = db.insert_diagnostics(
         dataset_id=dataset_obj['id'],
         model_id=model_obj['id'],
         ingestion_time=ingestion_timing,
@@ -127,22 +205,34 @@ def run():
         f1_score=score,
         packages_csv=packages_df.to_csv()
     )
+    db.insert_stage_timings(diagnostics_id, profiling.get_timings())
+    profiling.clear_timings()
 
     db.insert_dataset_summary(
         dataset_id=dataset_obj['id'],
-        lastmonth_activity_mean=summary.loc['mean']['lastmonth_activity'],
-        lastmonth_activity_median=summary.loc['median']['lastmonth_activity'],
-        lastmonth_activity_stddev=summary.loc['stddev']['lastmonth_activity'],
-        lastmonth_activity_missing=pct_missing['lastmonth_activity'],
-        lastyear_activity_mean=summary.loc['mean']['lastyear_activity'],
-        lastyear_activity_median=summary.loc['median']['lastyear_activity'],
-        lastyear_activity_stddev=summary.loc['stddev']['lastyear_activity'],
-        lastyear_activity_missing=pct_missing['number_of_employees'],
-        number_of_employees_mean=summary.loc['mean']['number_of_employees'],
-        number_of_employees_median=summary.loc['median']['number_of_employees'],
-        number_of_employees_stddev=summary.loc['stddev']['number_of_employees'],
-        number_of_employees_missing=pct_missing['number_of_employees'],
+        statistics=profile.to_records(),
+        profile=profile.to_dict()
     )
+    return diagnostics_id
+
+
+def run():
+    """Calculates all required reporting data and saves to database
+    """
+    db = ProjectDB()
+
+    dataset_obj = db.get_latest_dataset()
+    dataset = dataset_obj['data']
+
+    model_obj = db.get_latest_model()
+    model = model_obj['model']
+
+    score = score_model(dataset, model)
+    logging.info("Calculating summary statistics")
+    profile = DatasetProfile.from_chunks(dataset, columns=FEATURES)
+    packages_df = outdated_packages_list()
+
+    return record_diagnostics(dataset_obj, model_obj, score, profile, packages_df)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,174 @@
+"""
+Provides statistical drift detection between the training data of the deployed model and newly ingested data.
+Both are summarized as `DatasetProfile` quantile sketches and compared per column with the population stability
+index (PSI) and the two-sample Kolmogorov-Smirnov statistic. Deciding whether to retrain reads only the new rows
+and never scores the model.
+"""
+
+import json
+import logging
+import logging.config
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from datasetprofile import DatasetProfile
+from dbsetup import ProjectDB
+from ingestion import FingerprintIndex, row_fingerprints
+from schema import FEATURES
+
+
+# floor of bin fractions in the PSI, so empty bins do not make it infinite
+PSI_EPSILON = 1e-4
+
+
+def population_stability_index(reference, current, bins=10):
+    """PSI of two quantile sketches, over bins holding equal fractions of the reference values.
+    """
+    edges = np.unique(reference.quantile(np.linspace(0, 1, bins + 1)[1:-1]))
+    expected = np.clip(np.diff(np.r_[0.0, reference.cdf(edges), 1.0]), PSI_EPSILON, None)
+    actual = np.clip(np.diff(np.r_[0.0, current.cdf(edges), 1.0]), PSI_EPSILON, None)
+    return float(np.sum((actual - expected) * np.log(actual / expected)))
+
+
+def ks_statistic(reference, current):
+    """Largest distance between the empirical distribution functions of two quantile sketches.
+    """
+    points = np.union1d(reference.values, current.values)
+    return float(np.max(np.abs(reference.cdf(points) - current.cdf(points))))
+
+
+def ks_critical_value(n_reference, n_current, alpha):
+    """KS statistic above which two samples of these sizes differ at significance level `alpha`.
+    """
+    return float(np.sqrt(-np.log(alpha / 2) / 2 * (n_reference + n_current) / (n_reference * n_current)))
+
+
+def compare_profiles(reference, current, bins=10, psi_threshold=0.2, ks_alpha=0.05):
+    """Per-column drift statistics of the columns present in both profiles.
+
+    :return: dataframe indexed by column, with the PSI, KS statistic, KS critical value and whether either
+        exceeds its threshold
+    """
+    rows = []
+    for column in reference.columns:
+        if column not in current.columns:
+            continue
+        reference_sketch = reference.sketch(column)
+        current_sketch = current.sketch(column)
+        if reference_sketch.count == 0 or current_sketch.count == 0:
+            continue
+
+        psi = population_stability_index(reference_sketch, current_sketch, bins)
+        ks = ks_statistic(reference_sketch, current_sketch)
+        ks_critical = ks_critical_value(reference_sketch.count, current_sketch.count, ks_alpha)
+        rows.append((column, psi, ks, ks_critical, psi > psi_threshold or ks > ks_critical))
+
+    return pd.DataFrame(rows, columns=['column', 'psi', 'ks', 'ks_critical', 'drift']).set_index('column')
+
+
+def reference_profile(db, dataset_id):
+    """Profile of a dataset as stored by diagnostics, or computed from its data if none was stored.
+    """
+    state = db.get_dataset_profile(dataset_id)
+    if state is not None:
+        return DatasetProfile.from_dict(state)
+    logging.info("No stored profile of dataset %i, profiling it", dataset_id)
+    return DatasetProfile.from_chunks(db.iter_dataset_chunks(dataset_id), columns=FEATURES)
+
+
+def iter_new_rows(db, dataset_id, training_dataset):
+    """Chunks of the rows of a dataset that are not in the training dataset.
+
+    Rows appended to the training dataset by incremental ingestion are read directly. Any other dataset, such as a
+    rebuild that also holds the training rows, is read whole and filtered by row fingerprint.
+    """
+    if training_dataset in db.get_dataset_lineage(dataset_id):
+        yield from db.iter_dataset_chunks(dataset_id, after_dataset=training_dataset)
+        return
+
+    training_rows = db.get_row_hashes(training_dataset)
+    if training_rows is None:
+        fingerprints = [row_fingerprints(chunk) for chunk in db.iter_dataset_chunks(training_dataset)]
+        training_rows = np.unique(np.concatenate(fingerprints)) if fingerprints else None
+    seen = FingerprintIndex(training_rows)
+    for chunk in db.iter_dataset_chunks(dataset_id):
+        new = ~seen.contains(row_fingerprints(chunk))
+        if new.any():
+            yield chunk[new]
+
+
+def deployed_model_id(config):
+    """Id of the model in the deployment folder, or None if nothing was deployed.
+    """
+    version_path = Path(config['prod_deployment_path']) / Path("deployedversion.txt")
+    if not version_path.exists():
+        return None
+    with open(version_path) as f:
+        return int(f.read().strip())
+
+
+def detect_drift(config, db: ProjectDB):
+    """Compares the latest dataset with the training dataset of the deployed model.
+
+    Only the feature columns of rows that are not in the training dataset are profiled, see `iter_new_rows`.
+    Thresholds are read from the `drift_bins`, `drift_psi_threshold` and
+    `drift_ks_alpha` config variables.
+
+    :return: True if any column drifted, or if no deployed model can be compared against
+    """
+    model_id = deployed_model_id(config)
+    if model_id is None:
+        logging.info("No deployed model, drift detected: TRUE")
+        return True
+    training_dataset = db.get_model(model_id)['training_dataset']
+    if training_dataset is None:
+        logging.info("Deployed model %i not found, drift detected: TRUE", model_id)
+        return True
+
+    latest_dataset = db.get_latest_dataset_id()
+    if latest_dataset == training_dataset:
+        logging.info("No new data since dataset %i, drift detected: FALSE", training_dataset)
+        return False
+
+    reference = reference_profile(db, training_dataset)
+    current = DatasetProfile.from_chunks(iter_new_rows(db, latest_dataset, training_dataset), columns=FEATURES)
+    logging.info(
+        "Comparing %i new rows of dataset %i with %i rows of training dataset %i",
+        current.rows,
+        latest_dataset,
+        reference.rows,
+        training_dataset
+    )
+    if current.rows == 0:
+        logging.info("No new rows, drift detected: FALSE")
+        return False
+
+    report = compare_profiles(
+        reference,
+        current,
+        bins=config.get('drift_bins', 10),
+        psi_threshold=config.get('drift_psi_threshold', 0.2),
+        ks_alpha=config.get('drift_ks_alpha', 0.05)
+    )
+    for column, row in report.iterrows():
+        logging.info(
+            "%s: PSI %.4f, KS %.4f (critical %.4f), drift: %s",
+            column,
+            row['psi'],
+            row['ks'],
+            row['ks_critical'],
+            "TRUE" if row['drift'] else "FALSE"
+        )
+
+    drift = bool(report['drift'].any())
+    logging.info("Drift detected: %s", "TRUE" if drift else "FALSE")
+    return drift
+
+
+if __name__ == '__main__':
+    logging.config.fileConfig('logging.conf')
+    with open('config.json', 'r') as f:
+        config = json.load(f)
+    detect_drift(config, ProjectDB())
@@ -1,67 +1,170 @@
 import json
 import logging
 import logging.config
-import pickle
 from pathlib import Path
 
+import pandas as pd
+
 import deployment
 import diagnostics
+import drift
 import ingestion
-import reporting
 import scoring
-import training
+from datasetprofile import DatasetProfile
 from dbsetup import ProjectDB
+from pipeline import Pipeline, Stage, content_key
+from schema import FEATURES
 
 
 def check_model_exists(db: ProjectDB):
     model_obj = db.get_latest_model()
-    exists = model_obj['model'] is not None
+    exists = model_obj['id'] is not None
     return exists
 
 
 def check_new_data(config, db: ProjectDB):
-    ingested_files = db.get_latest_dataset()['file_list']
-    if ingested_files is None:
+    dataset_id = db.get_latest_dataset_id()
+    if dataset_id is None:
         return True
 
     else:
-        logging.info("Found %i files were previously ingested.", len(ingested_files))
-
         source_files = list(Path(config["input_folder_path"]).glob("*.csv"))
         logging.info("Found %s source files.", len(source_files))
 
-        new_files_present = any([file not in ingested_files for file in source_files])
+        previous_records = db.get_dataset_files(dataset_id)
+        if previous_records:
+            logging.info("Found %i files were previously ingested.", len(previous_records))
+            _, new_files, modified_files, removed_files = ingestion.compare_source_files(
+                source_files,
+                previous_records
+            )
+            logging.info(
+                "New files: %i, modified files: %i, removed files: %i",
+                len(new_files),
+                len(modified_files),
+                len(removed_files)
+            )
+            new_files_present = bool(new_files or modified_files or removed_files)
+
+        else:
+            # datasets ingested before file records were kept only list their filenames
+            ingested_files = db.get_latest_dataset()['file_list']
+            logging.info("Found %i files were previously ingested.", len(ingested_files))
+            new_files_present = any([str(file) not in ingested_files for file in source_files])
+
         logging.info("New files present: %s", 'TRUE' if new_files_present else 'FALSE')
 
         return new_files_present
 
 
 def check_model_drift(config, db: ProjectDB):
-    model_score_path = Path(config["prod_deployment_path"]) / Path("latestscore.txt")
-    if not model_score_path.exists():
-        return True
+    return drift.detect_drift(config, db)
 
-    else:
-        with open(model_score_path) as f:
-            recent_score = json.load(f)['f1_score']
-
-        production_model_path = Path(config['prod_deployment_path']) / Path("trainedmodel.pkl")
-        with open(production_model_path, 'rb') as file:
-            model = pickle.load(file)
 
-        new_data = db.get_latest_dataset()['data']
+def build_pipeline(config, db: ProjectDB):
+    """Stages of the full process, from detecting new source files to deploying a retrained model.
 
-        new_score = scoring.score_model(new_data, model)
+    Ingestion only runs when source files changed, and training only when no model exists or the new data drifted.
+    Summary statistics, scoring, the package check and the confusion matrix run concurrently.
+    """
 
-        drift = new_score < recent_score
-        logging.info(
-            "New model score (%f) vs previous (%f), drift detected: %s",
-            new_score,
-            recent_score,
-            "TRUE" if drift else "FALSE"
-        )
-
-        return drift
+    def list_source_files():
+        source_files = list(Path(config["input_folder_path"]).glob("*.csv"))
+        dataset_id = db.get_latest_dataset_id()
+        previous_records = {} if dataset_id is None else db.get_dataset_files(dataset_id)
+        return {'source_files': ingestion.compare_source_files(source_files, previous_records)[0]}
+
+    def ingest(source_files):
+        if check_new_data(config, db):
+            logging.info("Ingesting new data...")
+            dataset_id = ingestion.merge_multiple_dataframe()
+        else:
+            dataset_id = db.get_latest_dataset_id()
+        return {'dataset': db.get_dataset(dataset_id)}
+
+    def select_training_dataset(dataset):
+        if not check_model_exists(db) or check_model_drift(config, db):
+            return {'training_dataset': dataset}
+        return {'training_dataset': None}
+
+    # stages import sklearn and matplotlib when they first run, so runs without new data never load them
+    def train(training_dataset):
+        import training
+        logging.info("Training and Scoring new model...")
+        return {'model': db.get_model(training.train_model(dataset_obj=training_dataset))}
+
+    def score(training_dataset, model):
+        return {'score': scoring.score_model(training_dataset['data'], model['model'])}
+
+    def summarize(training_dataset):
+        logging.info("Calculating summary statistics")
+        return {'profile': DatasetProfile.from_chunks(training_dataset['data'], columns=FEATURES)}
+
+    def check_packages(model):
+        return {'packages': diagnostics.outdated_packages_list()}
+
+    def report(model):
+        import reporting
+        return {'confusion_matrix': str(reporting.run(model))}
+
+    def record_diagnostics(training_dataset, model, score, profile, packages):
+        return {'diagnostics': diagnostics.record_diagnostics(training_dataset, model, score, profile, packages)}
+
+    def deploy(model, diagnostics, confusion_matrix):
+        logging.info("Deploying...")
+        return {'deployed_model': deployment.deploy_latest(model)}
+
+    return Pipeline(
+        [
+            Stage(
+                "source_files", list_source_files, outputs=["source_files"],
+                key=lambda outputs: content_key(
+                    sorted((file, record['content_hash']) for file, record in outputs['source_files'].items())
+                )
+            ),
+            Stage(
+                "ingest", ingest, inputs=["source_files"], outputs=["dataset"],
+                save=lambda outputs: {'dataset': outputs['dataset']['id']},
+                restore=lambda record: {'dataset': db.get_dataset(record['dataset'])}
+            ),
+            Stage(
+                "drift", select_training_dataset, inputs=["dataset"], outputs=["training_dataset"],
+                save=lambda outputs: {
+                    'training_dataset': None if outputs['training_dataset'] is None else outputs['training_dataset']['id']
+                },
+                restore=lambda record: {
+                    'training_dataset': None if record['training_dataset'] is None
+                    else db.get_dataset(record['training_dataset'])
+                }
+            ),
+            Stage(
+                "train", train, inputs=["training_dataset"], outputs=["model"],
+                save=lambda outputs: {'model': outputs['model']['id']},
+                restore=lambda record: {'model': db.get_model(record['model'])}
+            ),
+            Stage(
+                "summarize", summarize, inputs=["training_dataset"], outputs=["profile"],
+                save=lambda outputs: {'profile': outputs['profile'].to_dict()},
+                restore=lambda record: {'profile': DatasetProfile.from_dict(record['profile'])}
+            ),
+            Stage("score", score, inputs=["training_dataset", "model"], outputs=["score"]),
+            Stage(
+                "check_packages", check_packages, inputs=["model"], outputs=["packages"],
+                save=lambda outputs: {'packages': outputs['packages'].to_dict(orient='list')},
+                restore=lambda record: {'packages': pd.DataFrame(record['packages'])}
+            ),
+            Stage("report", report, inputs=["model"], outputs=["confusion_matrix"]),
+            Stage(
+                "diagnostics", record_diagnostics,
+                inputs=["training_dataset", "model", "score", "profile", "packages"],
+                outputs=["diagnostics"]
+            ),
+            # as in a serial run, a model is only deployed once its report was written
+            Stage("deploy", deploy, inputs=["model", "diagnostics", "confusion_matrix"], outputs=["deployed_model"]),
+        ],
+        db,
+        workers=config.get('pipeline_workers', 4)
+    )
 
 
 if __name__ == '__main__':
@@ -73,30 +176,4 @@ if __name__ == '__main__':
     with open('config.json', 'r') as f:
         config = json.load(f)
 
-    model_exists = check_model_exists(db)
-    if model_exists:
-
-        new_data = check_new_data(config, db)
-        if not new_data:
-            quit()
-
-        logging.info("Ingesting new data...")
-        ingestion.merge_multiple_dataframe()
-
-        model_drift = check_model_drift(config, db)
-        if not model_drift:
-            quit()
-
-
-    logging.info("Ingesting data...")
-    ingestion.merge_multiple_dataframe()
-
-    logging.info("Training and Scoring new model...")
-    training.train_model()
-
-    logging.info("Diagnostics and Reporting...")
-    diagnostics.run()
-    reporting.run()
-
-    logging.info("Deploying...")
-    deployment.deploy_latest()
+    build_pipeline(config, db).run()
@@ -0,0 +1,53 @@
+"""
+Production serving profile, loaded by `gunicorn wsgi:app` from the project folder or by `python cli.py serve
+--production`. Settings come from the `serving_*` variables of config.json.
+
+The app is imported and the deployed model loaded once in the master process before workers are forked, so
+workers share those pages copy-on-write instead of each loading its own copy. Each worker then sends itself one
+request per endpoint before accepting connections.
+"""
+
+import gc
+import json
+import os
+
+# gunicorn reads module-level names as settings, and `config` is one of them
+with open('config.json', 'r') as f:
+    project_config = json.load(f)
+
+
+def _cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+bind = project_config.get('serving_bind', "0.0.0.0:8000")
+# predictions are cpu-bound, so one process per core, with threads overlapping request parsing and network waits
+workers = project_config.get('serving_workers') or _cores()
+worker_class = "gthread"
+threads = project_config.get('serving_threads', 4)
+# keep idle connections open for clients sending further requests, saving a TCP handshake per request
+keepalive = project_config.get('serving_keepalive', 5)
+backlog = 2048
+preload_app = True
+logconfig = "logging.conf"
+
+
+def when_ready(server):
+    """Runs in the master once the app is imported, before the first worker is forked."""
+    import app
+    app.model_registry.get()
+    app.response_bundle.get()
+    # objects surviving this far live as long as the master, so keep the garbage collector from touching, and
+    # thereby copying, their pages in the workers
+    gc.collect()
+    gc.freeze()
+    server.log.info("Preloaded model for %i workers", workers)
+
+
+def post_worker_init(worker):
+    import app
+    app.warm_up()
+    worker.log.info("Worker %i warmed up", worker.pid)
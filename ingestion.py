@@ -3,22 +3,318 @@ Provides functionality for reading and combining all data in a data folder.
 To meet rubric requirements, this file can be run on its own to generate `ingestedfiles.txt`.
 """
 
+import hashlib
 import json
 import logging
 import logging.config
+import os
+import timeit
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
+import profiling
 from dbsetup import ProjectDB
 
 
-def merge_multiple_dataframe(write_db=True, write_file=False):
+# known schema of the source files, the dtypes `pd.read_csv` infers for them, so a typed read matches an untyped one
+DATASET_DTYPES = {
+    "corporation": str,
+    "lastmonth_activity": "int64",
+    "lastyear_activity": "int64",
+    "number_of_employees": "int64",
+    "exited": "int64",
+}
+
+
+def read_source_file(file):
+    """Reads a source csv file with the known schema dtypes.
+
+    :return: tuple of the dataframe and seconds spent reading it
+    """
+    start_time = timeit.default_timer()
+    df = pd.read_csv(file, dtype=DATASET_DTYPES)
+    return df, timeit.default_timer() - start_time
+
+
+def read_source_files(input_filenames, workers=1, executor="thread"):
+    """Reads source csv files, in parallel when `workers` is more than one.
+    Dataframes are returned in the order of `input_filenames`, so concatenating them matches a serial read.
+
+    :param workers: number of files read at the same time
+    :param executor: 'thread' or 'process' pool
+    """
+    if workers > 1 and len(input_filenames) > 1:
+        pool_class = ProcessPoolExecutor if executor == "process" else ThreadPoolExecutor
+        with pool_class(max_workers=workers) as pool:
+            results = list(pool.map(read_source_file, input_filenames))
+    else:
+        results = [read_source_file(file) for file in input_filenames]
+
+    for file, (df, seconds) in zip(input_filenames, results):
+        logging.info("Read %s: %i rows in %.3fs", file, len(df), seconds)
+    return [df for df, _ in results]
+
+
+def row_fingerprints(chunk):
+    """64-bit hash of each row's values, equal for rows that `drop_duplicates` considers duplicates.
+    Numeric columns are hashed as floats so the same value read as int in one chunk and as float in another
+    still matches.
+    """
+    normalized = chunk.copy()
+    for col in normalized.columns:
+        if normalized[col].dtype.kind in "biuf":
+            normalized[col] = normalized[col].astype(np.float64)
+    return pd.util.hash_pandas_object(normalized, index=False).to_numpy()
+
+
+def estimate_chunksize(input_filenames, memory_budget_mb, indexed_rows=0, sample_rows=1000):
+    """Number of rows per chunk that keeps a chunk, its working copies and the fingerprint index of
+    `iter_deduplicated_chunks` within `memory_budget_mb`.
+
+    The index takes `FingerprintIndex.PEAK_BYTES_PER_ROW` per row, for the `indexed_rows` already in it and for every
+    row of the files, as estimated from their size. Chunks get the rest of the budget, but never less than a quarter
+    of it, so a budget smaller than the index is exceeded by the index rather than reduced to tiny chunks.
+    """
+    sample = pd.read_csv(input_filenames[0], nrows=sample_rows, dtype=DATASET_DTYPES)
+    bytes_per_row = max(1, sample.memory_usage(deep=True).sum() / max(1, len(sample)))
+
+    with open(input_filenames[0], 'rb') as f:
+        sample_bytes = sum(len(line) for _, line in zip(range(sample_rows + 1), f))
+    file_bytes_per_row = max(1, sample_bytes / (len(sample) + 1))
+    expected_rows = indexed_rows + sum(os.path.getsize(file) for file in input_filenames) / file_bytes_per_row
+    index_bytes = expected_rows * FingerprintIndex.PEAK_BYTES_PER_ROW
+
+    budget = memory_budget_mb * 2 ** 20
+    if index_bytes > budget * 3 / 4:
+        logging.warning(
+            "Fingerprint index of about %.0fMB exceeds the ingestion memory budget of %iMB",
+            index_bytes / 2 ** 20,
+            memory_budget_mb
+        )
+    chunk_budget = max(budget / 4, budget - index_bytes)
+    # a chunk is held alongside its fingerprinting copy and its encoded form
+    return max(1, int(chunk_budget / (4 * bytes_per_row)))
+
+
+def file_record(file, previous=None):
+    """Content hash, size and modification time of a source file.
+    The hash in `previous` is reused without reading the file when size and modification time are unchanged.
+    """
+    st = os.stat(file)
+    if previous is not None and previous['size'] == st.st_size and previous['mtime_ns'] == st.st_mtime_ns:
+        return dict(previous)
+
+    sha256 = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            sha256.update(block)
+    return {'content_hash': sha256.hexdigest(), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def compare_source_files(input_filenames, previous_records):
+    """Compares source files against the file records of a previous dataset version.
+
+    :return: tuple of current file records, new files, modified files and removed files
+    """
+    records = {}
+    new_files = []
+    modified_files = []
+    for file in input_filenames:
+        previous = previous_records.get(str(file))
+        records[str(file)] = file_record(file, previous)
+        if previous is None:
+            new_files.append(file)
+        elif records[str(file)]['content_hash'] != previous['content_hash']:
+            modified_files.append(file)
+    removed_files = [file for file in previous_records if file not in records]
+    return records, new_files, modified_files, removed_files
+
+
+class FingerprintIndex:
+    """Set of 64-bit row fingerprints held as sorted uint64 arrays, 8 bytes per fingerprint.
+
+    Fingerprints are added as a new sorted run, which is merged with the run before it while that one is not larger,
+    so there are at most log2(n) runs to search and each fingerprint is merged at most log2(n) times. A merge
+    briefly holds a copy of the runs it merges, hence `PEAK_BYTES_PER_ROW`.
+    """
+
+    PEAK_BYTES_PER_ROW = 16
+
+    def __init__(self, fingerprints=None):
+        """:param fingerprints: unique uint64 fingerprints to start with, sorted in place when writable"""
+        self._runs = []
+        if fingerprints is not None and len(fingerprints) > 0:
+            run = np.asarray(fingerprints, dtype=np.uint64)
+            if not run.flags.writeable:
+                run = run.copy()
+            run.sort()
+            self._runs.append(run)
+
+    def __len__(self):
+        return sum(len(run) for run in self._runs)
+
+    def contains(self, fingerprints):
+        """Boolean array telling which of `fingerprints` are in the index.
+        """
+        found = np.zeros(len(fingerprints), dtype=bool)
+        for run in self._runs:
+            positions = np.minimum(np.searchsorted(run, fingerprints), len(run) - 1)
+            found |= run[positions] == fingerprints
+        return found
+
+    def add(self, fingerprints):
+        """Adds fingerprints, which must be unique and not yet in the index.
+        """
+        if len(fingerprints) == 0:
+            return
+        self._runs.append(np.sort(np.asarray(fingerprints, dtype=np.uint64)))
+        while len(self._runs) > 1 and len(self._runs[-2]) <= len(self._runs[-1]):
+            run = self._runs.pop()
+            # a stable sort of two concatenated sorted runs is a linear merge
+            self._runs[-1] = np.sort(np.concatenate([self._runs[-1], run]), kind='stable')
+
+
+def iter_deduplicated_chunks(input_filenames, chunksize, seen=None):
+    """Reads csv files in chunks of `chunksize` rows and yields only rows not seen in any earlier chunk.
+    Concatenating the chunks gives the same dataframe as concatenating the files and calling `drop_duplicates`.
+
+    Memory use is one chunk plus a `FingerprintIndex` of the unique rows, which `estimate_chunksize` accounts for.
+
+    :param seen: `FingerprintIndex` of rows already in the dataset, extended in place
+    :return: generator of (chunk, fingerprints of its rows) pairs
+    """
+    seen = FingerprintIndex() if seen is None else seen
+    total_rows = 0
+    unique_rows = 0
+    for file in input_filenames:
+        for chunk in pd.read_csv(file, chunksize=chunksize, dtype=DATASET_DTYPES):
+            total_rows += len(chunk)
+            fingerprints = row_fingerprints(chunk)
+            keep = ~pd.Series(fingerprints).duplicated().to_numpy()
+            keep &= ~seen.contains(fingerprints)
+            seen.add(fingerprints[keep])
+            unique_rows += int(keep.sum())
+            if keep.any():
+                yield chunk[keep], fingerprints[keep]
+
+    logging.info("Rows in total dataset: %i", total_rows)
+    logging.info("After removing duplicates: %i", unique_rows)
+
+
+def _write_input_file_log(log_filename, input_filenames):
+    logging.info("Writing input file log to %s", log_filename)
+    with open(log_filename, 'w') as lf:
+        lf.write(str(datetime.now()))
+        lf.write('\n')
+        for fn in input_filenames:
+            lf.write(str(fn))
+            lf.write('\n')
+
+
+def _tee_to_csv(chunks, output_filename):
+    """Writes (chunk, fingerprints) pairs to a csv file as they pass through.
+    """
+    logging.info("Writing dataset to %s", output_filename)
+    with open(output_filename, 'w', newline='') as output_file:
+        for i, (chunk, fingerprints) in enumerate(chunks):
+            chunk.to_csv(output_file, index=False, header=i == 0)
+            yield chunk, fingerprints
+
+
+def stream_multiple_dataframe(config, input_filenames, write_db=True, write_file=False, file_records=None):
+    """Streaming version of `merge_multiple_dataframe` for datasets larger than memory.
+    Files are read in chunks sized by the `ingestion_memory_budget_mb` config variable, and each
+    de-duplicated chunk is written to the outputs before the next one is read.
+
+    :return: id of the new dataset, or None if `write_db` is False
+    """
+    chunksize = estimate_chunksize(input_filenames, config.get('ingestion_memory_budget_mb', 256))
+    logging.info("Streaming datasets in chunks of %i rows", chunksize)
+    chunks = iter_deduplicated_chunks(input_filenames, chunksize)
+
+    if write_file:
+        chunks = _tee_to_csv(chunks, Path(config['output_folder_path']) / Path("finaldata.csv"))
+
+    dataset_id = None
+    if write_db:
+        db = ProjectDB()
+        dataset_id = db.insert_dataset_chunks(
+            input_filenames=','.join(map(str, input_filenames)),
+            chunks=chunks,
+            file_records=file_records
+        )
+    else:
+        for _ in chunks:
+            pass
+
+    if write_file:
+        _write_input_file_log(Path(config['output_folder_path']) / Path("ingestedfiles.txt"), input_filenames)
+    return dataset_id
+
+
+def ingest_incremental(config, input_filenames, write_file=False):
+    """Incremental version of `merge_multiple_dataframe` that only reads new source files.
+
+    Rows of files not in the latest dataset version are de-duplicated against its stored row hashes and appended
+    to it as a new version. The dataset is rebuilt from all files instead when a previously ingested file was
+    modified or removed, or when the latest version was not stored in chunks.
+
+    :return: id of the latest dataset after ingestion
+    """
+    db = ProjectDB()
+    previous_id = db.get_latest_dataset_id()
+    previous_records = {} if previous_id is None else db.get_dataset_files(previous_id)
+    file_records, new_files, modified_files, removed_files = compare_source_files(input_filenames, previous_records)
+    row_hashes = None if previous_id is None else db.get_row_hashes(previous_id)
+
+    if row_hashes is None or not previous_records or modified_files or removed_files:
+        logging.info(
+            "Rebuilding dataset, %i modified and %i removed source files",
+            len(modified_files),
+            len(removed_files)
+        )
+        return stream_multiple_dataframe(config, input_filenames, write_file=write_file, file_records=file_records)
+
+    if not new_files:
+        logging.info("No new source files, keeping dataset %i", previous_id)
+        return previous_id
+
+    logging.info("Appending %i new source files to dataset %i", len(new_files), previous_id)
+    chunksize = estimate_chunksize(
+        new_files,
+        config.get('ingestion_memory_budget_mb', 256),
+        indexed_rows=len(row_hashes)
+    )
+    # stored row hashes are unique, so they are sorted in place into the index without a set or a copy
+    dataset_id = db.insert_dataset_chunks(
+        input_filenames=','.join(map(str, input_filenames)),
+        chunks=iter_deduplicated_chunks(new_files, chunksize, seen=FingerprintIndex(row_hashes)),
+        file_records=file_records,
+        parent_dataset=previous_id
+    )
+
+    if write_file:
+        chunks = ((chunk, None) for chunk in db.iter_dataset_chunks(dataset_id))
+        for _ in _tee_to_csv(chunks, Path(config['output_folder_path']) / Path("finaldata.csv")):
+            pass
+        _write_input_file_log(Path(config['output_folder_path']) / Path("ingestedfiles.txt"), input_filenames)
+    return dataset_id
+
+
+@profiling.timed("ingestion")
+def merge_multiple_dataframe(write_db=True, write_file=False, streaming=None, incremental=None):
     """Reads all csv files in `input_folder_path` config variable and combines them into a single dataset.
 
     :param write_db: write result to the database
     :param write_file: write result to a file using `output_folder_path` config variable
+    :param streaming: read and write the dataset in chunks, defaults to the `ingestion_streaming` config variable
+    :param incremental: only ingest new source files, defaults to the `ingestion_incremental` config variable.
+        Requires `write_db`.
+    :return: id of the ingested dataset, or None if `write_db` is False
     """
     with open('config.json', 'r') as f:
         config = json.load(f)
@@ -28,8 +324,31 @@ def merge_multiple_dataframe(write_db=True, write_file=False):
     # check for datasets
     logging.info("Found %i datasets", len(input_filenames))
 
+    if incremental is None:
+        incremental = config.get('ingestion_incremental', False)
+    if incremental and write_db:
+        return ingest_incremental(config, input_filenames, write_file=write_file)
+
+    file_records = None
+    if write_db:
+        db = ProjectDB()
+        previous_id = db.get_latest_dataset_id()
+        previous_records = {} if previous_id is None else db.get_dataset_files(previous_id)
+        file_records = compare_source_files(input_filenames, previous_records)[0]
+
+    if streaming is None:
+        streaming = config.get('ingestion_streaming', False)
+    if streaming:
+        return stream_multiple_dataframe(
+            config, input_filenames, write_db=write_db, write_file=write_file, file_records=file_records
+        )
+
     # compile them together,
-    datasets = [pd.read_csv(file) for file in input_filenames]
+    datasets = read_source_files(
+        input_filenames,
+        workers=config.get('ingestion_workers', 1),
+        executor=config.get('ingestion_executor', 'thread')
+    )
     combined_dataset = pd.concat(datasets, axis=0)
     logging.info("Rows in total dataset: %i, columns: %i", len(combined_dataset), len(combined_dataset.columns))
 
@@ -44,23 +363,15 @@ def merge_multiple_dataframe(write_db=True, write_file=False):
         combined_dataset.to_csv(output_filename, index=False)
 
         # log input files used
-        log_filename = Path(config['output_folder_path']) / Path("ingestedfiles.txt")
-        logging.info("Writing input file log to %s", log_filename)
-        with open(log_filename, 'w') as lf:
-            lf.write(str(datetime.now()))
-            lf.write('\n')
-            for fn in input_filenames:
-                lf.write(str(fn))
-                lf.write('\n')
+        _write_input_file_log(Path(config['output_folder_path']) / Path("ingestedfiles.txt"), input_filenames)
 
     if write_db:
         # write to db
-        db = ProjectDB()
         input_filenames = ','.join(map(str, input_filenames))
-        dataset = combined_dataset.to_csv()
-        db.insert_dataset(
+        return db.insert_dataset(
             input_filenames=input_filenames,
-            dataset=dataset
+            dataset=combined_dataset,
+            file_records=file_records
         )
 
 
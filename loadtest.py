@@ -0,0 +1,138 @@
+"""
+Provides a closed-loop load generator for the serving API.
+Each client thread keeps one connection alive and sends its next request as soon as the previous one completes,
+so the reported throughput is what the server sustains at that concurrency.
+"""
+
+import threading
+import timeit
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+# requests sent per endpoint: method, path and keyword arguments of `requests.Session.request`
+ENDPOINTS = {
+    "scoring": ("GET", "/scoring", {}),
+    "summarystats": ("GET", "/summarystats", {}),
+    "diagnostics": ("GET", "/diagnostics", {}),
+    "prediction": ("POST", "/prediction", {"json": [[234, 3, 10], [14, 2145, 99]]}),
+}
+
+# upper bounds of the latency histogram buckets in milliseconds, from 0.1ms to 10s in steps of about 1.6x
+HISTOGRAM_BUCKETS_MS = np.logspace(-1, 4, 26)
+
+
+def run_mix(targets, weights=None, clients=8, n_requests=None, duration=None, timeout=10.0, seed=0):
+    """Sends requests from `clients` threads until `n_requests` were sent or `duration` seconds passed, each
+    request going to a target drawn at random by weight.
+
+    :param targets: dict of target name to method, url and keyword arguments of `requests.Session.request`
+    :param weights: dict of target name to relative share of the requests, equal shares by default
+    :return: dict of the `seconds` the run took and the `targets` results, holding per target name the
+        `latencies` of successful requests in seconds and a `Counter` of `errors` by HTTP status or exception name
+    """
+    if n_requests is None and duration is None:
+        raise ValueError("either n_requests or duration is required")
+    names = list(targets)
+    p = np.array([1.0 if weights is None else weights.get(name, 0.0) for name in names])
+    p /= p.sum()
+
+    lock = threading.Lock()
+    sent = [0]
+    results = {name: {'latencies': [], 'errors': Counter()} for name in names}
+    start_time = timeit.default_timer()
+    deadline = None if duration is None else start_time + duration
+
+    def take():
+        with lock:
+            sent[0] += 1
+            return n_requests is None or sent[0] <= n_requests
+
+    def client(client_number):
+        rng = np.random.default_rng(seed + client_number)
+        own = {name: {'latencies': [], 'errors': Counter()} for name in names}
+        with requests.Session() as session:
+            while (deadline is None or timeit.default_timer() < deadline) and take():
+                name = names[rng.choice(len(names), p=p)]
+                method, url, kwargs = targets[name]
+                request_time = timeit.default_timer()
+                try:
+                    response = session.request(method, url, timeout=timeout, **kwargs)
+                    response.content
+                    error = None if response.ok else f"HTTP {response.status_code}"
+                except requests.RequestException as e:
+                    error = type(e).__name__
+                if error is None:
+                    own[name]['latencies'].append(timeit.default_timer() - request_time)
+                else:
+                    own[name]['errors'][error] += 1
+        with lock:
+            for name in names:
+                results[name]['latencies'].extend(own[name]['latencies'])
+                results[name]['errors'].update(own[name]['errors'])
+
+    with ThreadPoolExecutor(clients) as pool:
+        for future in [pool.submit(client, i) for i in range(clients)]:
+            future.result()
+
+    seconds = timeit.default_timer() - start_time
+    for result in results.values():
+        result['latencies'] = np.array(result['latencies'])
+    return {'seconds': seconds, 'targets': results}
+
+
+def run_load(url, method="GET", n_requests=1000, concurrency=8, timeout=10.0, **kwargs):
+    """Sends `n_requests` requests to `url` from `concurrency` threads.
+
+    :param kwargs: passed to `requests.Session.request`, such as a `json` body
+    :return: dict of the `latencies` of successful requests in seconds, the number of `errors` and the
+        `seconds` the run took
+    """
+    result = run_mix({url: (method, url, kwargs)}, clients=concurrency, n_requests=n_requests, timeout=timeout)
+    return {
+        'latencies': result['targets'][url]['latencies'],
+        'errors': sum(result['targets'][url]['errors'].values()),
+        'seconds': result['seconds'],
+    }
+
+
+def summarize(result):
+    """Latency percentiles in milliseconds, requests per second and error rate of a `run_load` result.
+    """
+    latencies = result['latencies'] * 1000
+    total = len(latencies) + result['errors']
+    percentiles = np.percentile(latencies, [50, 90, 99]) if len(latencies) else [np.nan] * 3
+    return {
+        'requests': total,
+        'rps': total / result['seconds'],
+        'p50_ms': percentiles[0],
+        'p90_ms': percentiles[1],
+        'p99_ms': percentiles[2],
+        'max_ms': latencies.max() if len(latencies) else np.nan,
+        'error_rate': result['errors'] / total if total else 0.0,
+    }
+
+
+def latency_histogram(latencies):
+    """Counts of latencies in seconds per bucket of `HISTOGRAM_BUCKETS_MS`, the last bucket holding slower ones.
+
+    :return: list of dicts of the bucket's upper bound `le_ms`, None for the last bucket, and its `count`
+    """
+    counts = np.histogram(latencies * 1000, bins=[0, *HISTOGRAM_BUCKETS_MS, np.inf])[0]
+    bounds = [float(bound) for bound in HISTOGRAM_BUCKETS_MS] + [None]
+    return [{'le_ms': bound, 'count': int(count)} for bound, count in zip(bounds, counts)]
+
+
+def wait_until_up(url, timeout=30.0):
+    """Polls `url` until it responds, raising `TimeoutError` after `timeout` seconds.
+    """
+    deadline = timeit.default_timer() + timeout
+    while timeit.default_timer() < deadline:
+        try:
+            requests.get(url, timeout=1.0)
+            return
+        except requests.RequestException:
+            threading.Event().wait(0.2)
+    raise TimeoutError(f"{url} did not respond within {timeout}s")
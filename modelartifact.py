@@ -0,0 +1,112 @@
+"""
+Provides a compact, versioned file format for the binary linear models of `compiledmodel.py`.
+An artifact is a fixed-size header, json metadata and the raw float64 coefficients, so loading one is a
+memory map and a json parse, without unpickling an sklearn object graph or importing sklearn. Models that
+`CompiledModel` cannot represent are stored as pickle only.
+
+Layout, little-endian:
+
+    magic           8 bytes, b"LINMODEL"
+    schema version  uint32
+    metadata size   uint32, padded so the coefficients are 8-byte aligned
+    checksum        32 bytes, sha256 of the metadata and coefficients
+    metadata        json: model_type, dtype, n_features, intercept, classes, features
+    coefficients    n_features values of the metadata dtype
+"""
+
+import hashlib
+import json
+import mmap
+import struct
+
+import numpy as np
+
+from compiledmodel import CompiledModel, compile_model
+
+MAGIC = b"LINMODEL"
+SCHEMA_VERSION = 1
+MODEL_TYPE = "binary_linear"
+
+_HEADER = struct.Struct("<8sII32s")
+_ALIGNMENT = 8
+
+
+class ArtifactError(ValueError):
+    """Raised for models that cannot be written as an artifact and for invalid artifacts.
+    """
+
+
+def dumps(model, features=None):
+    """Serializes a fitted binary linear classifier, or a `CompiledModel`, to artifact bytes.
+
+    :param features: feature names in coefficient order, defaults to those the model was fitted with
+    """
+    compiled = compile_model(model)
+    if not isinstance(compiled, CompiledModel):
+        raise ArtifactError(f"{type(model).__name__} is not a binary linear classifier")
+
+    coef = np.ascontiguousarray(compiled.coef, dtype="<f8")
+    metadata = json.dumps({
+        'model_type': MODEL_TYPE,
+        'dtype': coef.dtype.str,
+        'n_features': len(coef),
+        # json floats round-trip exactly
+        'intercept': float(compiled.intercept),
+        'classes': compiled.classes.tolist(),
+        'features': compiled.features if features is None else list(features),
+    }).encode()
+    metadata += b" " * (-(_HEADER.size + len(metadata)) % _ALIGNMENT)
+    payload = metadata + coef.tobytes()
+    return _HEADER.pack(MAGIC, SCHEMA_VERSION, len(metadata), hashlib.sha256(payload).digest()) + payload
+
+
+def read_metadata(buffer, verify=True):
+    """Parses the header and metadata of an artifact.
+
+    :param buffer: artifact bytes, or any object supporting the buffer protocol such as an `mmap`
+    :param verify: check the checksum, which reads the whole artifact
+    :return: dict of the metadata, with `schema_version` and the `offset` of the coefficients added
+    """
+    view = memoryview(buffer)
+    if len(view) < _HEADER.size:
+        raise ArtifactError("Artifact is truncated")
+    magic, version, metadata_size, checksum = _HEADER.unpack_from(view)
+    if magic != MAGIC:
+        raise ArtifactError("Not a model artifact")
+    if version > SCHEMA_VERSION:
+        raise ArtifactError(f"Artifact schema version {version} is newer than the supported version {SCHEMA_VERSION}")
+    if verify and hashlib.sha256(view[_HEADER.size:]).digest() != checksum:
+        raise ArtifactError("Artifact checksum mismatch")
+
+    metadata = json.loads(bytes(view[_HEADER.size:_HEADER.size + metadata_size]))
+    if metadata['model_type'] != MODEL_TYPE:
+        raise ArtifactError(f"Unsupported model type {metadata['model_type']}")
+    metadata['schema_version'] = version
+    metadata['offset'] = _HEADER.size + metadata_size
+    return metadata
+
+
+def loads(buffer, float32=False, verify=True):
+    """Loads a `CompiledModel` from artifact bytes. In double precision the coefficients are a view of `buffer`
+    rather than a copy.
+
+    :param float32: evaluate in single precision, see `compiledmodel.compile_model`
+    """
+    metadata = read_metadata(buffer, verify)
+    coef = np.frombuffer(buffer, dtype=metadata['dtype'], count=metadata['n_features'], offset=metadata['offset'])
+    return CompiledModel(
+        coef,
+        metadata['intercept'],
+        metadata['classes'],
+        dtype=np.float32 if float32 else np.float64,
+        features=metadata['features']
+    )
+
+
+def load(path, float32=False, verify=True):
+    """Loads a `CompiledModel` from an artifact file, memory-mapped rather than read.
+    """
+    with open(path, 'rb') as file:
+        # the map stays open for as long as the coefficients reference it
+        buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    return loads(buffer, float32, verify)
@@ -0,0 +1,129 @@
+"""
+Provides a small DAG runner for the stages of the ML pipeline.
+Each stage declares the artifacts it consumes and produces. Artifacts are passed between stages in memory and
+identified by content keys, so a stage whose inputs have the same keys as in its last recorded run is skipped
+and its recorded outputs are restored instead. Stages whose inputs are ready run concurrently.
+"""
+
+import hashlib
+import json
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import profiling
+
+
+def content_key(*parts):
+    """Hex digest identifying json-serializable `parts`.
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class Stage:
+    """A pipeline step consuming and producing named artifacts.
+
+    :param func: called with the `inputs` artifacts as keyword arguments, returns a dict of the `outputs`
+        artifacts. An output of None means it was not produced, and stages consuming it do not run.
+    :param key: function of the outputs returning their content key. Stages with a key function always run,
+        which suits cheap stages that detect changes, such as hashing source files. By default an output is
+        keyed by the stage's input keys.
+    :param save: function turning the outputs into a json-serializable record, identity by default
+    :param restore: function turning a record back into outputs, identity by default
+    """
+
+    def __init__(self, name, func, inputs=(), outputs=(), key=None, save=None, restore=None):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.key = key
+        self.save = save or (lambda outputs: outputs)
+        self.restore = restore or (lambda record: record)
+
+    def input_key(self, keys):
+        return content_key(self.name, [keys[name] for name in self.inputs])
+
+
+class Pipeline:
+    """Runs stages in dependency order, recording each run in `ProjectDB` so unchanged stages are skipped.
+
+    :param stages: stages, each listed after the stages producing its inputs
+    :param db: `ProjectDB` storing stage runs
+    :param workers: number of stages run at the same time
+    """
+
+    def __init__(self, stages, db, workers=4):
+        self.stages = list(stages)
+        self.db = db
+        self.workers = workers
+
+        produced = set()
+        for stage in self.stages:
+            missing = set(stage.inputs) - produced
+            if missing:
+                raise ValueError(f"Stage {stage.name} consumes {sorted(missing)} before they are produced")
+            produced.update(stage.outputs)
+
+    def _run_stage(self, stage, kwargs):
+        logging.info("Running stage %s", stage.name)
+        with profiling.stage(f"pipeline.{stage.name}"):
+            outputs = stage.func(**kwargs) or {}
+        return {name: outputs.get(name) for name in stage.outputs}
+
+    def run(self, force=()):
+        """Runs all stages whose inputs changed since their last run.
+
+        :param force: names of stages to run even if their inputs did not change
+        :return: dict of artifact name to value, None for artifacts that were not produced
+        """
+        values = {}
+        keys = {}
+        pending = list(self.stages)
+        running = {}
+
+        def finish(stage, input_key, outputs):
+            for name in stage.outputs:
+                values[name] = outputs.get(name)
+                if values[name] is None:
+                    keys[name] = None
+                elif stage.key is not None:
+                    keys[name] = stage.key(outputs)
+                else:
+                    keys[name] = content_key(input_key, name)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while pending or running:
+                for stage in [s for s in pending if all(name in keys for name in s.inputs)]:
+                    pending.remove(stage)
+                    input_key = stage.input_key(keys)
+
+                    if any(values[name] is None for name in stage.inputs):
+                        logging.debug("Stage %s has missing inputs, not running", stage.name)
+                        finish(stage, input_key, {})
+                        continue
+
+                    if stage.key is None and stage.name not in force:
+                        last_run = self.db.get_latest_stage_run(stage.name)
+                        if last_run is not None and last_run[0] == input_key:
+                            logging.info("Stage %s is up to date, skipping", stage.name)
+                            finish(stage, input_key, stage.restore(last_run[1]))
+                            continue
+
+                    kwargs = {name: values[name] for name in stage.inputs}
+                    running[pool.submit(self._run_stage, stage, kwargs)] = (stage, input_key)
+
+                # stages finishing instantly may have made others ready
+                if any(all(name in keys for name in s.inputs) for s in pending):
+                    continue
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, input_key = running.pop(future)
+                    outputs = future.result()
+                    if stage.key is None:
+                        self.db.insert_stage_run(stage.name, input_key, stage.save(outputs))
+                    finish(stage, input_key, outputs)
+
+        return values
@@ -0,0 +1,157 @@
+"""
+Provides in-process instrumentation of pipeline stages.
+Stages record wall time, CPU time and peak memory while the pipeline runs, so diagnostics can report them without
+re-running anything. Peak memory comes from the peak resident set size of the process, which costs nothing to
+read. Benchmarks set `track_memory` to measure the allocations of each stage with tracemalloc instead, which is
+exact but slows down the stages being timed.
+"""
+
+import functools
+import logging
+import sys
+import threading
+import time
+import timeit
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# bounded, so a long-lived process that never calls `clear_timings` keeps only the latest records
+MAX_RECORDS = 10000
+_records = deque(maxlen=MAX_RECORDS)
+_records_lock = threading.Lock()
+
+# open stages that are tracing memory, innermost last
+_memory_stack = []
+_memory_lock = threading.Lock()
+
+track_memory = False
+
+
+def _peak_rss_mb():
+    """Peak resident set size of this process so far, or None where it is not available.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def _enter_memory_frame():
+    with _memory_lock:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        current, peak = tracemalloc.get_traced_memory()
+        if _memory_stack:
+            _memory_stack[-1]['peak'] = max(_memory_stack[-1]['peak'], peak)
+        tracemalloc.reset_peak()
+        frame = {'start': current, 'peak': current}
+        _memory_stack.append(frame)
+        return frame
+
+
+def _exit_memory_frame(frame):
+    with _memory_lock:
+        peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+        _memory_stack.remove(frame)
+        if _memory_stack:
+            _memory_stack[-1]['peak'] = max(_memory_stack[-1]['peak'], peak)
+        else:
+            tracemalloc.stop()
+        return peak - frame['start']
+
+
+@contextmanager
+def stage(name):
+    """Records wall time, CPU time and peak memory of the enclosed block under `name`.
+
+    CPU time is that of the thread running the block, so stages running concurrently in the pipeline do not count
+    each other's work. Work the block hands to pool threads or processes is not included.
+
+    Peak memory is by how much the block raised the peak resident set size of the process, so it is 0 for a block
+    that stayed below an earlier peak. With `track_memory`, it is instead the peak memory allocated by the block as
+    measured with tracemalloc while any stage is open. Stages may be nested; stages running concurrently in other
+    threads are included in each other's peak memory.
+    """
+    frame = _enter_memory_frame() if track_memory else None
+    start_rss = _peak_rss_mb() if frame is None else None
+    start_wall = timeit.default_timer()
+    start_cpu = time.thread_time()
+    try:
+        yield
+    finally:
+        record = {
+            'stage': name,
+            'wall_time': timeit.default_timer() - start_wall,
+            'cpu_time': time.thread_time() - start_cpu,
+            'peak_memory_mb': _exit_memory_frame(frame) / 2 ** 20 if frame is not None else _rss_growth(start_rss),
+        }
+        with _records_lock:
+            _records.append(record)
+        logging.debug("Stage %s took %.3fs", name, record['wall_time'])
+
+
+def _rss_growth(start_rss):
+    return None if start_rss is None else _peak_rss_mb() - start_rss
+
+
+def timed(name):
+    """Decorator recording each call of a function as a `stage`.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_timings(name=None):
+    """Stage records of this process, oldest first, optionally only those of stage `name`.
+    At most the latest `MAX_RECORDS` records are kept.
+    """
+    with _records_lock:
+        return [record for record in _records if name is None or record['stage'] == name]
+
+
+def latest_timing(name):
+    """Most recent record of stage `name`, or None if it did not run in this process.
+    """
+    timings = get_timings(name)
+    return timings[-1] if timings else None
+
+
+def clear_timings():
+    with _records_lock:
+        _records.clear()
+
+
+def benchmark(func, repeat, name=None):
+    """Runs `func` `repeat` times as a stage and summarizes its timings.
+
+    :return: dict of statistic name to value, with percentiles of wall and CPU time in seconds
+    """
+    name = name or func.__name__
+    for _ in range(repeat):
+        with stage(name):
+            func()
+
+    timings = get_timings(name)[-repeat:]
+    summary = {'stage': name, 'repeat': repeat}
+    for key in ('wall_time', 'cpu_time'):
+        values = np.array([record[key] for record in timings])
+        for q in (50, 90, 99):
+            summary[f"{key}_p{q}"] = float(np.percentile(values, q))
+        summary[f"{key}_max"] = float(values.max())
+    memory = [record['peak_memory_mb'] for record in timings if record['peak_memory_mb'] is not None]
+    summary['peak_memory_mb_max'] = max(memory) if memory else None
+    return summary
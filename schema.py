@@ -0,0 +1,11 @@
+"""
+Provides the feature columns of the dataset, shared by training, scoring, diagnostics, drift detection and serving.
+Kept free of pandas and sklearn imports, so any module can use it without slowing down its import.
+"""
+
+# columns the model is trained on and predicts from, in the order of its coefficients
+FEATURES = [
+    "lastmonth_activity",
+    "lastyear_activity",
+    "number_of_employees",
+]
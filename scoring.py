@@ -9,22 +9,23 @@ import logging.config
 from pathlib import Path
 
 import pandas as pd
-from sklearn import metrics
 
+import profiling
+from compiledmodel import compile_model
 from dbsetup import ProjectDB
+from schema import FEATURES
 
 
+@profiling.timed("scoring")
 def score_model(test_data, model):
     """Scores the latest model on an input dataframe
     """
     y = test_data["exited"]
-    X = test_data[[
-        "lastmonth_activity",
-        "lastyear_activity",
-        "number_of_employees",
-    ]]
+    X = test_data[FEATURES]
 
-    y_pred = model.predict(X)
+    from sklearn import metrics  # slow to import, loaded on first use
+
+    y_pred = compile_model(model).predict(X)
     score = metrics.f1_score(y, y_pred)
     logging.info("Test score: %f", score)
     return score
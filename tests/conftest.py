@@ -0,0 +1,6 @@
+import sys
+from pathlib import Path
+
+# the project is a folder of scripts rather than a package, so tests import its modules from the project root
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
@@ -0,0 +1,17 @@
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+import ingestion
+from conftest import PROJECT_ROOT
+
+SOURCE_FILES = sorted((PROJECT_ROOT / Path("sourcedata")).glob("*.csv")) + \
+    sorted((PROJECT_ROOT / Path("practicedata")).glob("*.csv"))
+
+
+@pytest.mark.parametrize("workers, executor", [(1, "thread"), (4, "thread"), (4, "process")])
+def test_read_source_files_matches_serial_read(workers, executor):
+    expected = pd.concat(pd.read_csv(file) for file in SOURCE_FILES)
+    result = pd.concat(ingestion.read_source_files(SOURCE_FILES, workers=workers, executor=executor))
+    pd.testing.assert_frame_equal(result, expected)
@@ -0,0 +1,46 @@
+import importlib
+import io
+
+import numpy as np
+import pytest
+from sklearn.linear_model import LogisticRegression
+
+from compiledmodel import CompiledModel
+from conftest import PROJECT_ROOT
+
+NON_FINITE_ROWS = [[1.0, 2.0, np.nan], [1.0, np.inf, 3.0], [-np.inf, 2.0, 3.0]]
+
+
+@pytest.fixture
+def client(monkeypatch):
+    # app reads config.json from the working directory on import
+    monkeypatch.chdir(PROJECT_ROOT)
+    app = importlib.import_module("app")
+    return app.app.test_client()
+
+
+def test_compiled_model_matches_sklearn_and_rejects_non_finite_input():
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(200, 3))
+    model = LogisticRegression(solver="liblinear").fit(X, X.sum(axis=1) > 0)
+    compiled = CompiledModel.from_model(model)
+    np.testing.assert_array_equal(compiled.predict(X), model.predict(X))
+
+    for row in NON_FINITE_ROWS:
+        with pytest.raises(ValueError):
+            model.predict([row])
+        with pytest.raises(ValueError):
+            compiled.predict([row])
+
+
+def test_prediction_rejects_non_finite_json(client):
+    response = client.post("/prediction", json=[[1, 2, None]])
+    assert response.status_code == 400
+    assert "finite" in response.get_json()["error"]
+
+
+def test_prediction_rejects_non_finite_npy(client):
+    body = io.BytesIO()
+    np.save(body, np.array(NON_FINITE_ROWS))
+    response = client.post("/prediction", data=body.getvalue(), content_type="application/x-npy")
+    assert response.status_code == 400
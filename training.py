@@ -4,49 +4,267 @@ To meet rubric requirements, this file can be ran independently to pickle and
 write the model to disk as `trainedmodel.pkl`.
 """
 
+import copy
 import json
 import logging
 import logging.config
 import pickle
+import timeit
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
 from pathlib import Path
 
-from sklearn.linear_model import LogisticRegression
+import numpy as np
+import sklearn
+from sklearn.linear_model import LogisticRegression, SGDClassifier
+from sklearn.metrics import f1_score
+from sklearn.model_selection import ParameterGrid, ParameterSampler, StratifiedKFold
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
 
+import profiling
 from dbsetup import ProjectDB
+from schema import FEATURES
 
 
-def train_model(write_db=True, write_file=False):
+# solvers of LogisticRegression that can start from the coefficients of a previous model
+WARM_START_SOLVERS = {"lbfgs", "newton-cg", "sag", "saga"}
+
+# logistic loss of SGDClassifier, renamed in sklearn 1.1
+LOG_LOSS = "log_loss" if tuple(int(v) for v in sklearn.__version__.split(".")[:2]) >= (1, 1) else "log"
+
+# training data of search worker processes, sent once per worker rather than once per candidate
+_worker_data = None
+
+
+def make_model(params=None, solver='liblinear', warm_start_model=None):
+    """Logistic regression classifier with `params` overriding the defaults.
+
+    :param warm_start_model: fitted model whose coefficients the fit starts from, if the solver supports it
+    """
+    clf = LogisticRegression(
+        C=1.0, class_weight=None, dual=False, fit_intercept=True,
+        intercept_scaling=1, l1_ratio=None, max_iter=100, n_jobs=None, penalty='l2',
+        random_state=0, solver=solver, tol=0.0001, verbose=0,
+        warm_start=False
+    )
+    clf.set_params(**(params or {}))
+
+    if warm_start_model is not None and clf.solver in WARM_START_SOLVERS:
+        clf.set_params(warm_start=True)
+        clf.coef_ = warm_start_model.coef_.copy()
+        clf.intercept_ = warm_start_model.intercept_.copy()
+    return clf
+
+
+def search_candidates(config):
+    """Parameter sets to evaluate, from the `training_search` and `training_param_grid` config variables.
+    A single empty parameter set means no search.
+    """
+    method = config.get('training_search', 'none')
+    grid = config.get('training_param_grid', {})
+    if method == 'grid':
+        return list(ParameterGrid(grid))
+    if method == 'random':
+        return list(ParameterSampler(grid, n_iter=config.get('training_search_iterations', 10), random_state=0))
+    return [{}]
+
+
+def _init_worker(X, y):
+    global _worker_data
+    _worker_data = (X, y)
+
+
+def evaluate_candidate(params, solver, folds):
+    """Cross-validated f1 score of a parameter set, on the data given to `_init_worker`.
+    Folds are fitted from scratch, as a warm start from a model fitted on all rows would have seen the held-out ones.
+
+    :return: dict of the parameters, mean and standard deviation of the fold scores and seconds spent fitting
+    """
+    X, y = _worker_data
+    scores = []
+    fit_time = 0.0
+    for train_index, test_index in StratifiedKFold(n_splits=folds, shuffle=True, random_state=0).split(X, y):
+        clf = make_model(params, solver)
+        start_time = timeit.default_timer()
+        clf.fit(X[train_index], y[train_index])
+        fit_time += timeit.default_timer() - start_time
+        scores.append(f1_score(y[test_index], clf.predict(X[test_index])))
+    return {
+        'params': params,
+        'mean_score': float(np.mean(scores)),
+        'std_score': float(np.std(scores)),
+        'fit_time': fit_time,
+    }
+
+
+def search(X, y, candidates, config):
+    """Evaluates candidate parameter sets with cross-validation, in parallel over `training_workers` workers
+    of the `training_executor` pool type. Datasets of fewer than `training_process_min_rows` rows are evaluated on
+    threads instead of processes, as starting processes would take longer than the fits.
+
+    :return: tuple of the best parameters and the list of trials, as returned by `evaluate_candidate`
+    """
+    folds = min(config.get('training_cv_folds', 5), int(np.bincount(y).min()))
+    if folds < 2:
+        logging.warning("Too few samples per class for cross-validation, using the first candidate")
+        return candidates[0], []
+
+    solver = config.get('training_solver', 'liblinear')
+    workers = config.get('training_workers', 1)
+    logging.info("Evaluating %i candidates with %i-fold cross-validation", len(candidates), folds)
+    if workers > 1:
+        small = len(X) < config.get('training_process_min_rows', 100000)
+        if config.get('training_executor', 'process') == 'process' and not small:
+            # spawn rather than fork, as the pipeline runs training alongside other threads
+            pool = ProcessPoolExecutor(
+                max_workers=workers, mp_context=get_context('spawn'), initializer=_init_worker, initargs=(X, y)
+            )
+        else:
+            _init_worker(X, y)
+            pool = ThreadPoolExecutor(workers)
+        with pool:
+            trials = list(pool.map(
+                evaluate_candidate,
+                candidates,
+                [solver] * len(candidates),
+                [folds] * len(candidates)
+            ))
+    else:
+        _init_worker(X, y)
+        trials = [evaluate_candidate(params, solver, folds) for params in candidates]
+
+    best = max(trials, key=lambda trial: trial['mean_score'])
+    for trial in trials:
+        trial['selected'] = trial is best
+        logging.debug("Candidate %s: f1 %.4f", trial['params'], trial['mean_score'])
+    logging.info("Selected %s with cross-validated f1 %.4f", best['params'], best['mean_score'])
+    return best['params'], trials
+
+
+def fit_incremental(iter_chunks, config, previous_model=None):
+    """Fits a scaled logistic regression by stochastic gradient descent, one chunk at a time.
+
+    :param iter_chunks: callable returning an iterable of dataframe chunks, called once per pass over the data
+    :param config: config with `training_epochs` passes and `training_sgd_alpha` regularization
+    :param previous_model: model returned by an earlier call, which training continues from. Its scaler is kept
+        so the coefficients stay comparable.
+    :return: `Pipeline` of a `StandardScaler` and an `SGDClassifier`
+    """
+    if previous_model is not None:
+        previous_model = copy.deepcopy(previous_model)
+        scaler, clf = previous_model.named_steps['scale'], previous_model.named_steps['sgd']
+    else:
+        scaler = StandardScaler()
+        for chunk in iter_chunks():
+            scaler.partial_fit(chunk[FEATURES].astype(np.float64))
+        clf = SGDClassifier(loss=LOG_LOSS, alpha=config.get('training_sgd_alpha', 0.0001), random_state=0)
+
+    epochs = config.get('training_epochs', 5)
+    rows = 0
+    for _ in range(epochs):
+        rows = 0
+        for chunk in iter_chunks():
+            X = scaler.transform(chunk[FEATURES].astype(np.float64))
+            clf.partial_fit(X, chunk["exited"].to_numpy(), classes=np.array([0, 1]))
+            rows += len(chunk)
+    logging.info("Fitted %i rows in %i passes", rows, epochs)
+    return Pipeline([('scale', scaler), ('sgd', clf)])
+
+
+def is_incremental_model(model):
+    return isinstance(model, Pipeline) and isinstance(model.named_steps.get('sgd'), SGDClassifier)
+
+
+def train_incremental(db, dataset_obj, config):
+    """Trains with `fit_incremental` on chunks streamed from the database, without loading the whole dataset.
+    When the latest model was trained incrementally on an earlier version of this dataset, training continues
+    from it on the rows appended since.
+    """
+    previous = db.get_latest_model()
+    after_dataset = None
+    previous_model = None
+    if (
+        config.get('training_warm_start', False)
+        and previous['id'] is not None
+        and previous['training_dataset'] in db.get_dataset_lineage(dataset_obj['id'])[:-1]
+        and is_incremental_model(previous['model'])
+    ):
+        logging.info("Continuing model %i on rows added since dataset %i", previous['id'], previous['training_dataset'])
+        after_dataset = previous['training_dataset']
+        previous_model = previous['model']
+
+    return fit_incremental(
+        lambda: db.iter_dataset_chunks(dataset_obj['id'], after_dataset=after_dataset),
+        config,
+        previous_model
+    )
+
+
+def warm_start_candidate(db, dataset_obj, config):
+    """Latest model to start batch training from, when `training_warm_start` is set, the solver supports warm
+    starts, and the model was trained on an earlier version of this dataset that grew incrementally into it.
+    Otherwise None.
+    """
+    solver = config.get('training_solver', 'liblinear')
+    if not config.get('training_warm_start', False) or solver not in WARM_START_SOLVERS:
+        return None
+
+    previous = db.get_latest_model()
+    if (
+        previous['id'] is None
+        or previous['training_dataset'] not in db.get_dataset_lineage(dataset_obj['id'])[:-1]
+        or getattr(previous['model'], "coef_", np.empty((0, 0))).shape != (1, len(FEATURES))
+    ):
+        return None
+    logging.info("Warm-starting from model %i, trained on dataset %i", previous['id'], previous['training_dataset'])
+    return previous['model']
+
+
+@profiling.timed("training")
+def train_model(write_db=True, write_file=False, dataset_obj=None):
     """Train a logistic regression classifier on the latest dataset and save it.
 
-    :param write_db: write model to database
+    Parameters are chosen by cross-validated search when `training_search` is configured. With `training_warm_start`,
+    fits start from the coefficients of the latest stored model. With `training_mode` set to `incremental`, the
+    dataset is streamed in chunks into `train_incremental` instead.
+
+    :param write_db: write model and search trials to database
     :param write_file: write model to file
+    :param dataset_obj: handle of the dataset to train on, defaults to the latest dataset
+    :return: id of the stored model, or None if `write_db` is False
     """
     with open('config.json', 'r') as f:
         config = json.load(f)
 
-    logging.info("Reading latest data from sqlite")
     db = ProjectDB()
-    dataset_obj = db.get_latest_dataset()
-    dataset = dataset_obj['data']
+    if dataset_obj is None:
+        logging.info("Reading latest data from sqlite")
+        dataset_obj = db.get_latest_dataset()
+
+    if config.get('training_mode', 'batch') == 'incremental':
+        clf = train_incremental(db, dataset_obj, config)
+        return _save_model(db, config, clf, dataset_obj, [], write_db, write_file)
 
+    dataset = dataset_obj['data']
     y = dataset["exited"]
-    X = dataset[[
-        "lastmonth_activity",
-        "lastyear_activity",
-        "number_of_employees",
-    ]]
+    X = dataset[FEATURES]
 
-    clf = LogisticRegression(
-        C=1.0, class_weight=None, dual=False, fit_intercept=True,
-        intercept_scaling=1, l1_ratio=None, max_iter=100, n_jobs=None, penalty='l2',
-        random_state=0, solver='liblinear', tol=0.0001, verbose=0,
-        warm_start=False
-    )
+    warm_start_model = warm_start_candidate(db, dataset_obj, config)
+
+    candidates = search_candidates(config)
+    params, trials = candidates[0], []
+    if len(candidates) > 1:
+        params, trials = search(X.to_numpy(dtype=np.float64), y.to_numpy(), candidates, config)
 
+    clf = make_model(params, config.get('training_solver', 'liblinear'), warm_start_model)
     logging.info("Fitting model.")
     clf.fit(X, y)
     logging.info("Score on training data: %f", clf.score(X, y))
+    return _save_model(db, config, clf, dataset_obj, trials, write_db, write_file)
+
 
+def _save_model(db, config, clf, dataset_obj, trials, write_db, write_file):
     if write_file:
         model_path = Path(config['output_model_path']) / Path("trainedmodel.pkl")
         logging.info("Saving model to %s", model_path)
@@ -54,7 +272,9 @@ def train_model(write_db=True, write_file=False):
             pickle.dump(clf, file)
 
     if write_db:
-        db.insert_model(model=clf, training_dataset_id=dataset_obj['id'])
+        model_id = db.insert_model(model=clf, training_dataset_id=dataset_obj['id'])
+        db.insert_training_trials(model_id, trials)
+        return model_id
 
 
 if __name__ == "__main__":
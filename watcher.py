@@ -0,0 +1,107 @@
+"""
+Provides a long-running replacement for launching `fullprocess.py` from cron.
+The watcher imports the pipeline and opens the database once, polls `input_folder_path` for changed source files
+and runs the pipeline once a burst of file arrivals has settled. Polling only compares file sizes and
+modification times, so checking for new data takes milliseconds.
+"""
+
+import json
+import logging
+import logging.config
+import os
+import signal
+import threading
+import timeit
+
+import fullprocess
+from dbsetup import ProjectDB
+
+
+def snapshot(folder):
+    """Size and modification time of each csv file in `folder`, by filename.
+    """
+    files = {}
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.name.endswith(".csv") and entry.is_file():
+                st = entry.stat()
+                files[entry.name] = (st.st_size, st.st_mtime_ns)
+    return files
+
+
+class SourceWatcher:
+    """Polls a folder for added, modified or removed csv files.
+
+    :param poll_seconds: seconds between polls
+    :param debounce_seconds: seconds the folder must stay unchanged after a change before it is reported, so
+        files still being copied and bursts of arrivals trigger one run
+    """
+
+    def __init__(self, folder, poll_seconds=1.0, debounce_seconds=5.0):
+        self.folder = folder
+        self.poll_seconds = poll_seconds
+        self.debounce_seconds = debounce_seconds
+        self._last = snapshot(folder)
+
+    def wait_for_change(self, stop_event):
+        """Blocks until the folder changed and then stayed unchanged for `debounce_seconds`.
+
+        :return: True on a change, False if `stop_event` was set first
+        """
+        changed_at = None
+        while not stop_event.wait(self.poll_seconds):
+            current = snapshot(self.folder)
+            if current != self._last:
+                logging.debug("Source files changed, waiting for them to settle")
+                self._last = current
+                changed_at = timeit.default_timer()
+            elif changed_at is not None and timeit.default_timer() - changed_at >= self.debounce_seconds:
+                return True
+        return False
+
+
+def run_pipeline(pipeline):
+    start_time = timeit.default_timer()
+    try:
+        pipeline.run()
+    except Exception:
+        logging.exception("Pipeline run failed")
+    logging.info("Pipeline run finished in %.3fs", timeit.default_timer() - start_time)
+
+
+def stop_on_signals():
+    """Event set on SIGINT or SIGTERM, so the watcher finishes a running pipeline before exiting.
+    """
+    stop_event = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop_event.set())
+    return stop_event
+
+
+def watch(config, stop_event=None):
+    """Runs the pipeline once, then again whenever the source files change, until `stop_event` is set.
+    """
+    stop_event = stop_event or threading.Event()
+    db = ProjectDB()
+    pipeline = fullprocess.build_pipeline(config, db)
+    watcher = SourceWatcher(
+        config['input_folder_path'],
+        poll_seconds=config.get('watcher_poll_seconds', 1.0),
+        debounce_seconds=config.get('watcher_debounce_seconds', 5.0)
+    )
+
+    run_pipeline(pipeline)
+    logging.info("Watching %s for new data", config['input_folder_path'])
+    while watcher.wait_for_change(stop_event):
+        logging.info("Source files changed")
+        run_pipeline(pipeline)
+    logging.info("Watcher stopped")
+
+
+if __name__ == '__main__':
+    logging.config.fileConfig('logging.conf')
+
+    with open('config.json', 'r') as f:
+        config = json.load(f)
+
+    watch(config, stop_on_signals())